@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2016 Markus Haehnel
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+"""
+Fake Yokogawa WT230 on a pseudo terminal to try the sampler without instrument.
+"""
+
+
+import os, pty, tty, time, threading, random
+import argparse as ags
+import yokogawa
+
+
+class FakeInstrument(threading.Thread):
+    """
+    Answers queries of the sampler on a pseudo terminal.
+
+    :param rate: update interval of measured data in seconds
+    :type rate: float
+    :param baudrate: emulated transfer rate of replies
+    :type baudrate: int
+    """
+    def __init__(self, rate=0.1, baudrate=9600):
+        super().__init__(daemon=True)
+        self.rate = rate
+        self.baudrate = baudrate
+        self._master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._start = time.monotonic()
+        self._cleared = 0       # updates until last read of extended event register
+
+    def updates(self):
+        """Number of data updates since start."""
+        return int((time.monotonic() - self._start) / self.rate)
+
+    def reply(self, command):
+        """Reply to command, None if the command has no reply."""
+        if command == "COMMUNICATE:WAIT 1":
+            # block until UPD bit is set
+            if self.updates() <= self._cleared:
+                time.sleep((self._cleared + 1) * self.rate - (time.monotonic() - self._start))
+        elif command == "STATUS:EESR?":
+            updates = self.updates()
+            eesr = yokogawa.reg_eesr_mask.UPD if updates > self._cleared else 0
+            self._cleared = updates
+            return "{}\n".format(eesr)
+        elif command == "MEASURE:VALUE?":
+            r = random.Random(self.updates())      # same values within an update interval
+            return "{:.2f},{:.4f},{:.1f}\n".format(230 + r.random(), 0.5, 115 + r.random())
+        return None
+
+    def run(self):
+        buffer = b""
+        while True:
+            buffer += os.read(self._master, 1024)
+            *lines, buffer = buffer.split(b"\n")
+            for l in lines:
+                reply = self.reply(l.decode().strip())
+                if reply is not None:
+                    # 10 bit per byte on the serial line
+                    time.sleep(len(reply) * 10 / self.baudrate)
+                    os.write(self._master, reply.encode())
+
+
+def benchmark(duration=10, depth=4, rate=0.1, baudrate=9600):
+    """
+    Compare the query loop waiting for each data update with the pipelined
+    acquisition, both detecting new data with the extended event register.
+
+    :returns: distinct updates, skipped duplicates and dropped updates per second of each variant
+    :rtype: dict
+    """
+    fake = FakeInstrument(rate=rate, baudrate=baudrate)
+    fake.start()
+    yoko = yokogawa.Yokogawa(fake.port)
+    result = dict()
+    for (key, samples) in (("wait", lambda: yoko.samples(status=True)),
+                           ("pipeline", lambda: yoko.acquire(depth, status=True))):
+        yoko.clock = yokogawa.UpdateClock(rate)
+        n, end = 0, time.monotonic() + duration
+        for sample in samples():
+            n += 1
+            if time.monotonic() >= end:
+                break
+        result[key] = dict(updates=n / duration, duplicated=yoko.clock.duplicated / duration,
+                           dropped=yoko.clock.dropped / duration)
+    return result
+
+
+def main():
+    parser = ags.ArgumentParser("Fake Yokogawa WT230 on a pseudo terminal.")
+    parser.add_argument("-r", "--rate", type=float, default=0.1, help="update interval in seconds")
+    parser.add_argument("-b", "--baudrate", type=int, default=9600, help="emulated baud rate")
+    parser.add_argument("--benchmark", type=float, metavar="SECONDS",
+                        help="measure updates/s of the sampler's loops instead of serving")
+    parser.add_argument("--pipeline", type=int, default=4, help="pipelined queries of benchmark")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        for (key, val) in benchmark(args.benchmark, args.pipeline, args.rate, args.baudrate).items():
+            print("{:10} {updates:6.1f} updates/s {duplicated:6.1f} duplicates/s {dropped:6.1f} dropped/s".format(key, **val))
+        return 0
+
+    fake = FakeInstrument(rate=args.rate, baudrate=args.baudrate)
+    print(fake.port)
+    fake.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -23,7 +23,7 @@
 
 import serial
 import datetime
-import os
+import os, sys, time, struct, signal, threading, collections, selectors, bisect, json
 import argparse as ags
 
 
@@ -43,9 +43,59 @@ class reg_eesr_mask: # extended event register mask
        
 
 
+class UpdateClock(object):
+    """
+    Timestamps on the grid of the instrument's data updates.
+
+    The first sample anchors the grid to the system time. Every later sample
+    is placed on the update interval nearest to the time passed since the
+    anchor on the monotonic clock, so serial latency and scheduling jitter
+    neither end up in the timestamps nor add up. If the EESR UPD bit is
+    known, it decides whether the data is new.
+
+    :param rate: update interval in seconds, see Yokogawa.configure_value()
+    :type rate: float
+    """
+    def __init__(self, rate=0.1):
+        self.rate = rate
+        self.dropped = 0        # update intervals never read
+        self.duplicated = 0     # samples of an update interval already read
+        self._origin = None
+        self._anchor = None     # monotonic time of first sample
+        self._index = 0
+
+    def stamp(self, monotonic, updated=None):
+        """
+        :param monotonic: time.monotonic() at arrival of the data
+        :type monotonic: float
+        :param updated: data was updated since last sample (EESR UPD bit), None if unknown
+        :type updated: bool
+        :returns: UNIX timestamp of the data update
+        :rtype: float
+        """
+        if self._origin is None:
+            self._origin = time.time() - (time.monotonic() - monotonic)
+            self._anchor = monotonic
+            return self._origin
+        index = max(round((monotonic - self._anchor) / self.rate), self._index)
+        if updated is not None:
+            index = max(index, self._index + 1) if updated else self._index
+        n = index - self._index
+        if n == 0:
+            self.duplicated += 1
+        self.dropped += max(n - 1, 0)
+        self._index = index
+        return self._origin + self._index * self.rate
+
+
 class Yokogawa(object):
+    """
+    :param comport: serial port number or device name, e.g. '/dev/ttyS0'
+    :type comport: int or str
+    """
     def __init__(self, comport=0, baudrate=9600):
         self._serial = serial.Serial(comport,baudrate)
+        self.clock = UpdateClock()
 
     def write(self, string):
         return self._serial.write(string.encode())
@@ -65,6 +115,7 @@ class Yokogawa(object):
             self.write("CONFIGURE:CURRENT:RANGE {}\n".format(current))
         if samplerate is not None:
             self.write("SAMPLE:RATE {}\n".format(samplerate))
+            self.clock.rate = samplerate
 
     def configure(self, measuretype):
         """
@@ -100,46 +151,507 @@ class Yokogawa(object):
         """
         self.write("*CLS\n")
     
-    def get_measured_data(self, status=False):
+    def read_eesr(self):
+        """Read and thereby clear the extended event register."""
+        self.write("STATUS:EESR?\n")
+        return int(self.readline().split()[-1])
+
+    def _measure(self, status):
         if status:
-            # clear the extended event register
-            self.write("STATUS:EESR?\n")
-            status = self.readline()
-            print(datetime.datetime.now(), status)
+            # clear the extended event register, so that waiting ends with a new update
+            self.read_eesr()
 
         # wait for the completion of data updating
         self.write("COMMUNICATE:WAIT 1\n") 
         self.write("MEASURE:VALUE?\n")
-        return "{},{}".format(datetime.datetime.now(),
-                                self.readline())
+        reply = self.readline()
+        return self.clock.stamp(time.monotonic(), True if status else None), reply
+
+    def get_measured_data(self, status=False):
+        """
+        :param status: detect dropped updates with the extended event register
+        :type status: bool
+        :returns: CSV line of timestamp and raw reply
+        :rtype: str
+        """
+        t, reply = self._measure(status)
+        return "{},{}".format(datetime.datetime.fromtimestamp(t), reply)
+
+    def get_measured_values(self, status=False):
+        """
+        :param status: detect dropped updates with the extended event register
+        :type status: bool
+        :returns: UNIX timestamp and voltage, current, power ('nan' if not readable)
+        :rtype: float, tuple(float, float, float)
+        """
+        t, reply = self._measure(status)
+        return t, parse_values(reply)
+
+    def samples(self, status=False):
+        """
+        Read measured data, waiting for each data update.
+
+        :param status: detect dropped updates with the extended event register
+        :type status: bool
+        :returns: generator of UNIX timestamp and raw reply
+        :rtype: float, str
+        """
+        while True:
+            t, reply = self._measure(status)
+            yield t, reply.strip()
+
+    def acquire(self, depth=4, status=False):
+        """
+        Read measured data continuously without waiting for each data update.
+
+        Keeps up to depth 'MEASURE:VALUE?' queries in flight and reads
+        the replies in bulk from the serial buffer. Consecutive replies
+        may repeat the values of the same update interval. If status is
+        set, they are detected with the extended event register, counted in
+        clock.duplicated and skipped.
+
+        :param depth: number of pipelined queries
+        :type depth: int
+        :param status: query the extended event register with each value
+        :type status: bool
+        :returns: generator of UNIX timestamp and raw reply
+        :rtype: float, str
+        """
+        query = "STATUS:EESR?\nMEASURE:VALUE?\n" if status else "MEASURE:VALUE?\n"
+        self.write(query * depth)
+        buffer, eesr = b"", None
+        while True:
+            buffer += self._serial.read(max(1, self._serial.in_waiting))
+            now = time.monotonic()
+            *lines, buffer = buffer.split(b"\n")
+            for l in lines:
+                l = l.decode().strip()
+                if status and eesr is None:
+                    eesr = int(l.split()[-1])
+                    continue
+                updated = None if eesr is None else bool(eesr & reg_eesr_mask.UPD)
+                eesr = None
+                self.write(query)
+                if updated is False:
+                    self.clock.duplicated += 1
+                    continue
+                yield self.clock.stamp(now, updated), l
+
+
+def acquire_many(instruments, status=False, clock=None):
+    """
+    Read measured data of several instruments concurrently, one row per data update.
+
+    The queries are sent to all instruments at once and the replies are
+    collected with select() on the serial ports, so a row takes as long
+    as the slowest instrument instead of the sum of all of them.
+
+    :param instruments: configured instruments
+    :type instruments: list(Yokogawa)
+    :param status: clear the extended event register before waiting for an update
+    :type status: bool
+    :param clock: timestamps of the rows, by default on the update grid of the first instrument
+    :type clock: UpdateClock
+    :returns: generator of UNIX timestamp and joined raw replies of all instruments
+    :rtype: float, str
+    """
+    if clock is None:
+        clock = UpdateClock(instruments[0].clock.rate)
+    selector = selectors.DefaultSelector()
+    for (i, yoko) in enumerate(instruments):
+        selector.register(yoko._serial.fileno(), selectors.EVENT_READ, i)
+    query = ("STATUS:EESR?\n" if status else "") + "COMMUNICATE:WAIT 1\nMEASURE:VALUE?\n"
+    buffers = [b""] * len(instruments)
+    while True:
+        for yoko in instruments:
+            yoko.write(query)
+        replies = [None] * len(instruments)
+        eesr = [status] * len(instruments)      # reply of EESR query still expected
+        while None in replies:
+            for (key, events) in selector.select():
+                i, serial = key.data, instruments[key.data]._serial
+                buffers[i] += serial.read(max(1, serial.in_waiting))
+                while replies[i] is None and b"\n" in buffers[i]:
+                    l, buffers[i] = buffers[i].split(b"\n", 1)
+                    if eesr[i]:
+                        eesr[i] = False
+                    else:
+                        replies[i] = l.decode().strip()
+        yield clock.stamp(time.monotonic(), True if status else None), ",".join(replies)
+
+
+class Sampler(object):
+    """
+    Reads samples in a producer thread into a queue, so that a slow disk
+    or terminal does not delay the next query of the instrument.
+
+    The producer only appends and the consumer only pops, which is safe
+    on a deque without a lock.
+
+    :param samples: iterable of samples, e.g. Yokogawa.acquire()
+    :type samples: iterable
+    :param maxlen: capacity of the queue, newer samples are dropped if full
+    :type maxlen: int
+    """
+    def __init__(self, samples, maxlen=100000):
+        self._samples = samples
+        self._queue = collections.deque()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self.maxlen = maxlen
+        self.read = 0
+        self.written = 0
+        self.dropped = 0
+        self.maxdepth = 0
+
+    def _produce(self):
+        for sample in self._samples:
+            self.read += 1
+            if len(self._queue) >= self.maxlen:
+                self.dropped += 1
+                continue
+            self._queue.append(sample)
+            self.maxdepth = max(self.maxdepth, len(self._queue))
+
+    def start(self):
+        self._thread.start()
+
+    def drain(self):
+        """Remove and return all queued samples."""
+        batch = [self._queue.popleft() for i in range(len(self._queue))]
+        self.written += len(batch)
+        return batch
+
+    def batches(self, interval=0.5):
+        """Generator of all samples queued within each interval until the producer ended."""
+        while self._thread.is_alive():
+            time.sleep(interval)
+            yield self.drain()
+
+    def stats(self):
+        """
+        :returns: samples read, written, queued, maximal queued and dropped
+        :rtype: dict
+        """
+        return dict(read=self.read, written=self.written, depth=len(self._queue),
+                    maxdepth=self.maxdepth, dropped=self.dropped)
+
+
+def read_csv(f):
+    """Samples of lines 'timestamp,voltage,current,power' of another sampler, e.g. WT230."""
+    for l in f:
+        timestamp, _, reply = l.partition(",")
+        try:
+            t = datetime.datetime.fromisoformat(timestamp).timestamp()
+        except ValueError:      # header
+            continue
+        yield t, reply.strip()
+
+
+class P2Quantile(object):
+    """
+    Estimate of a quantile with five markers instead of all samples
+    (P² algorithm, Jain & Chlamtac 1985).
+
+    :param p: quantile between 0 and 1
+    :type p: float
+    """
+    def __init__(self, p):
+        self.p = p
+        self._q = []                                # marker heights
+        self._n = [0, 1, 2, 3, 4]                   # marker positions
+        self._np = [0, 2*p, 4*p, 2 + 2*p, 4]        # desired positions
+        self._dn = [0, p/2, p, (1 + p)/2, 1]
+
+    def add(self, x):
+        q, n = self._q, self._n
+        if len(q) < 5:
+            bisect.insort(q, x)
+            return
+        if x < q[0]:
+            q[0] = x
+        elif x > q[4]:
+            q[4] = x
+        k = min(max(bisect.bisect_right(q, x) - 1, 0), 3)
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self._np[i] += self._dn[i]
+        for i in (1, 2, 3):
+            d = self._np[i] - n[i]
+            if (d >= 1 and n[i+1] - n[i] > 1) or (d <= -1 and n[i-1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # parabolic prediction, linear if not monotonic
+                h = q[i] + d / (n[i+1] - n[i-1]) * ((n[i] - n[i-1] + d) * (q[i+1] - q[i]) / (n[i+1] - n[i]) +
+                                                   (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / (n[i] - n[i-1]))
+                if not q[i-1] < h < q[i+1]:
+                    h = q[i] + d * (q[i+d] - q[i]) / (n[i+d] - n[i])
+                q[i] = h
+                n[i] += d
+
+    def value(self):
+        if not self._q:
+            return float("nan")
+        if len(self._q) < 5:
+            return self._q[round(self.p * (len(self._q) - 1))]
+        return self._q[2]
+
+
+class Summary(object):
+    """
+    Running aggregates of the power of a trace in constant memory:
+    energy (trapezoidal rule), mean, variance (Welford), extremes and quantiles.
+
+    :param quantiles: quantiles to estimate
+    :type quantiles: tuple(float)
+    """
+    def __init__(self, quantiles=(0.5, 0.95, 0.99)):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.energy = 0.0
+        self.start = None
+        self._last = None
+        self.quantiles = [P2Quantile(q) for q in quantiles]
+
+    def add(self, timestamp, power):
+        if power != power:      # nan
+            return
+        if self._last is None:
+            self.start = timestamp
+        else:
+            self.energy += (timestamp - self._last[0]) * (power + self._last[1]) / 2
+        self._last = (timestamp, power)
+        self.n += 1
+        delta = power - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (power - self.mean)
+        self.min = min(self.min, power)
+        self.max = max(self.max, power)
+        for q in self.quantiles:
+            q.add(power)
+
+    def variance(self):
+        return self._m2 / (self.n - 1) if self.n > 1 else float("nan")
+
+    def result(self):
+        """
+        :returns: number of samples, duration [s], energy [J], mean, variance, min, max and quantiles of power [W]
+        :rtype: dict
+        """
+        return dict(n=self.n, duration=0.0 if self._last is None else self._last[0] - self.start,
+                    energy=self.energy, mean=self.mean, variance=self.variance(),
+                    min=self.min, max=self.max,
+                    quantiles={str(q.p): q.value() for q in self.quantiles})
+
+
+def parse_values(reply, channels=1):
+    """Convert 'voltage,current,power[,voltage,...]' reply of the instruments to floats."""
+    values = []
+    for v in reply.strip().split(",")[:3*channels]:
+        try:                values.append(float(v))
+        except ValueError:  values.append(float("nan"))
+    return tuple(values + [float("nan")] * (3*channels - len(values)))
+
+
+class BinaryLog(object):
+    """
+    Compact log of fixed-width records: float64 UNIX timestamp and
+    float32 voltage, current and power of each channel.
+
+    :param fname: path of log file, appended if existing
+    :type fname: str
+    :param buffersize: number of records collected before writing
+    :type buffersize: int
+    :param fsync: seconds between forcing the data to disk
+    :type fsync: float
+    :param channels: number of instruments (1-9)
+    :type channels: int
+    """
+    magic = b"YOKOBIN"      # followed by number of channels
+
+    def __init__(self, fname, buffersize=64, fsync=10, channels=1):
+        if not 1 <= channels <= 9:
+            raise Exception("A binary log has 1 to 9 channels, not {}.".format(channels))
+        self.record = struct.Struct("<d" + "fff" * channels)
+        header = self.magic + str(channels).encode()
+        size = os.path.getsize(fname) if os.path.exists(fname) else 0
+        if size:
+            # append only to a log of the same channels ending with a complete record
+            with open(fname, "rb") as f:
+                if f.read(len(header)) != header:
+                    raise Exception("'{}' is no binary Yokogawa log of {} channel(s).".format(fname, channels))
+            if (size - len(header)) % self.record.size:
+                raise Exception("'{}' ends with a partly written record.".format(fname))
+        self._file = open(fname, "ab")
+        if size == 0:
+            self._file.write(header)
+        self._buffer = []
+        self.buffersize = buffersize
+        self.fsync = fsync
+        self._synced = time.monotonic()
+
+    def write(self, timestamp, values):
+        self._buffer.append(self.record.pack(timestamp, *values))
+        if len(self._buffer) >= self.buffersize:
+            self.flush()
+
+    def flush(self):
+        self._file.write(b"".join(self._buffer))
+        self._buffer = []
+        self._file.flush()
+        if time.monotonic() - self._synced >= self.fsync:
+            os.fsync(self._file.fileno())
+            self._synced = time.monotonic()
+
+    def close(self):
+        self.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load(fname):
+    """
+    Memory-map a binary log into a NumPy record array with fields
+    timestamp, voltage, current and power, numbered from 0 for several channels.
+    """
+    import numpy
+
+    offset = len(BinaryLog.magic) + 1
+    with open(fname, "rb") as f:
+        header = f.read(offset)
+    if header[:-1] != BinaryLog.magic or not header[-1:].isdigit():
+        raise Exception("'{}' is no binary Yokogawa log.".format(fname))
+    channels = int(header[-1:])
+    fields = [("voltage", "<f4"), ("current", "<f4"), ("power", "<f4")]
+    if channels > 1:
+        fields = [("{}{}".format(name, i), t) for i in range(channels) for (name, t) in fields]
+    dtype = numpy.dtype([("timestamp", "<f8")] + fields)
+    n = (os.path.getsize(fname) - offset) // dtype.itemsize     # ignore a partly written last record
+    return numpy.memmap(fname, dtype=dtype, mode="r", offset=offset, shape=(n,))
 
 
 def main():
     parser = ags.ArgumentParser("Measurement of voltage, current and power consumption via Yokogawa.")
     parser.add_argument("-d", "--dir", default=os.path.join("/home", "lab", "frehiwot", "power"), help="directory")
-    parser.add_argument("-f", "--file", help="file name")
-    parser.add_argument("-m", "--mode", default="230V", choices=["230V", "12V", "5V"],
-                        help="measurement mode")
+    parser.add_argument("-f", "--file", help="file name, '-' for stdout")
+    parser.add_argument("-m", "--mode", action="append", choices=["230V", "12V", "5V"],
+                        help="measurement mode (default: 230V), once for all or for each port")
+    parser.add_argument("--format", default="csv", choices=["csv", "bin"],
+                        help="log format, 'bin' for fixed-width binary records (see load())")
+    parser.add_argument("-p", "--port", action="append", type=lambda p: int(p) if p.isdigit() else p,
+                        help="serial port number or device (default: 0), repeat for several instruments")
+    parser.add_argument("--pipeline", type=int, default=0,
+                        help="number of pipelined queries instead of waiting for each data update, 0 to wait (one instrument only)")
+    parser.add_argument("--no-status", dest="status", action="store_false",
+                        help="do not detect dropped and duplicated updates with the extended event register")
+    parser.add_argument("-s", "--summary",
+                        help="JSON file of energy and power statistics per channel, written on SIGUSR1 and at exit")
+    parser.add_argument("--csv-input", action="store_true",
+                        help="read 'timestamp,voltage,current,power' lines of another sampler from stdin instead of instruments")
     args = parser.parse_args()
+    if args.format == "bin" and args.file == "-":
+        parser.error("binary format can not be written to stdout")
+    ports = args.port or [0]
+    if args.format == "bin" and len(ports) > 9:
+        parser.error("binary format supports up to 9 instruments")
+    modes = args.mode or ["230V"]
+    if len(modes) == 1:
+        modes *= len(ports)
+    if len(modes) != len(ports):
+        parser.error("give one mode for all ports or one for each port")
+    if args.pipeline and len(ports) > 1:
+        parser.error("pipelined queries are supported for one instrument only")
 
-    if not os.path.exists(args.dir):
-        os.mkdir(args.dir)
-    logfile = os.path.join(args.dir, "{}.csv".format(datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")) if args.file is None else args.file)
-    print(logfile)
-
-    print("start")
-    yoko = Yokogawa()
-    print("before configure")
-    yoko.configure(args.mode)
-    print("measuring")
-    with open(logfile, "a") as f:
-        f.write("timestamp,voltage,current,power\n")
-        yoko.clear_error_queue()
-        while True:
-            print("reading")
-            f.write(yoko.get_measured_data())
+    # samples on stdout are streamed to the client: keep messages out of it
+    stream = args.file == "-"
+    log = (lambda *a: print(*a, file=sys.stderr)) if stream else print
+
+    if stream:
+        logfile = None
+    else:
+        if not os.path.exists(args.dir):
+            os.mkdir(args.dir)
+        logfile = os.path.join(args.dir, "{}.{}".format(datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), args.format) if args.file is None else args.file)
+    log(logfile)
+
+    # flush buffered records when stopped with kill
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit())
+
+    # before configuring the instruments, which takes a while: SIGUSR1 terminates by default
+    if args.csv_input:
+        ports = [None]
+    summaries = [Summary() for p in ports]
+    sampler = None
+    def summarize():
+        if args.summary is None:
+            return
+        with open(args.summary + ".tmp", "w") as f:
+            json.dump([s.result() for s in summaries], f)
+        os.replace(args.summary + ".tmp", args.summary)
+    def report(*signum):
+        if sampler is not None:
+            log(sampler.stats())
+        summarize()
+    signal.signal(signal.SIGUSR1, report)
+
+    if args.csv_input:
+        clock = UpdateClock()
+        samples = read_csv(sys.stdin)
+    else:
+        log("start")
+        instruments = [Yokogawa(p) for p in ports]
+        log("before configure")
+        for (yoko, mode) in zip(instruments, modes):
+            yoko.configure(mode)
+        log("measuring")
+
+        for yoko in instruments:
+            yoko.clear_error_queue()
+        if len(instruments) > 1:
+            clock = UpdateClock(instruments[0].clock.rate)
+            samples = acquire_many(instruments, args.status, clock)
+        else:
+            clock = instruments[0].clock
+            samples = instruments[0].acquire(args.pipeline, args.status) if args.pipeline \
+                        else instruments[0].samples(args.status)
+    sampler = Sampler(samples)
+
+    if args.format == "bin":
+        f = BinaryLog(logfile, channels=len(ports))
+        def write(batch):
+            for (t, reply) in batch:
+                f.write(t, parse_values(reply, len(ports)))
+    else:
+        f = sys.stdout if stream else open(logfile, "a")
+        f.write("timestamp,{}\n".format("voltage,current,power" if len(ports) == 1 else
+                ",".join("voltage{0},current{0},power{0}".format(i) for i in range(len(ports)))))
+        def write(batch):
+            f.write("".join("{},{}\n".format(datetime.datetime.fromtimestamp(t), reply) for (t, reply) in batch))
             f.flush()
+    def consume(batch):
+        write(batch)
+        for (t, reply) in batch:
+            values = parse_values(reply, len(ports))
+            for (i, s) in enumerate(summaries):
+                s.add(t, values[3*i + 2])
 
+    sampler.start()
+    try:
+        for batch in sampler.batches():
+            consume(batch)
+    finally:
+        consume(sampler.drain())
+        f.close()
+        report()
+        log("dropped updates: {}, duplicated updates: {}".format(clock.dropped, clock.duplicated))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2016 Markus Haehnel
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+"""
+Energy and power of the runs of a cpufreq-governor sweep from their power and dstat traces.
+"""
+
+
+import os, glob, re, csv
+import argparse
+from multiprocessing import Pool, cpu_count
+import numpy, pandas
+
+
+
+def read_power(fname):
+    """
+    Load a power trace of lines 'timestamp,voltage,current,power'.
+
+    :returns: trace with columns timestamp (local time), voltage, current and power
+    :rtype: pandas.DataFrame
+    """
+    df = pandas.read_csv(fname, header=None, names=["timestamp", "voltage", "current", "power"],
+                         usecols=[0, 1, 2, 3], dtype=str)
+    df["timestamp"] = pandas.to_datetime(df["timestamp"], format="ISO8601", errors="coerce")
+    for c in ("voltage", "current", "power"):
+        df[c] = pandas.to_numeric(df[c], errors="coerce")
+    # header lines (one per appended measurement) and broken lines
+    return df.dropna(subset=["timestamp", "power"]).sort_values("timestamp").reset_index(drop=True)
+
+
+
+def read_dstat(fname):
+    """
+    Load a CSV file of dstat including its header block.
+
+    Columns are named after group and item of the header, e.g. 'total cpu usage:idl'.
+    The year missing in dstat's time column is taken from the header's date.
+
+    :returns: trace with column timestamp (local time), utilisation [%] and dstat's columns
+    :rtype: pandas.DataFrame
+    """
+    year, groups, skip = None, None, 0
+    with open(fname, newline="") as f:
+        for row in csv.reader(f):
+            skip += 1
+            if "Date:" in row:
+                match = re.search(r"\b(\d{4})\b", row[row.index("Date:") + 1])
+                year = match.group(1) if match else None
+            elif row[:1] == ["system"]:
+                groups = row
+            elif row[:1] == ["time"]:
+                items = row
+                break
+        else:
+            raise Exception("'{}' is no dstat CSV file.".format(fname))
+    if groups is None:
+        groups = ["system"] + [""] * (len(items) - 1)
+    names, group = [], ""
+    for (i, item) in enumerate(items):
+        group = groups[i] if i < len(groups) and groups[i] else group
+        names.append("{}:{}".format(group, item))
+    df = pandas.read_csv(fname, header=None, names=names, skiprows=skip, dtype=str)
+    time = df.pop(names[0])
+    df = df.apply(pandas.to_numeric, errors="coerce")
+    year = year or str(pandas.Timestamp.fromtimestamp(os.path.getmtime(fname)).year)
+    df.insert(0, "timestamp", pandas.to_datetime(year + "-" + time, format="%Y-%d-%m %H:%M:%S", errors="coerce"))
+    idle = [c for c in names if c.endswith(":idl")]
+    if idle:
+        df.insert(1, "utilisation", 100.0 - df[idle[0]])
+    return df.dropna(subset=["timestamp"]).sort_values("timestamp").reset_index(drop=True)
+
+
+
+def cached(read, fname, cachedir=None):
+    """
+    Call read(fname) or load its result from a pickle, which is renewed if fname is newer.
+
+    :param cachedir: directory of pickles, '.cache' next to fname if None
+    :type cachedir: str
+    """
+    cachedir = os.path.join(os.path.dirname(fname), ".cache") if cachedir is None else cachedir
+    cache = os.path.join(cachedir, os.path.basename(fname) + ".pkl")
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(fname):
+        return pandas.read_pickle(cache)
+    df = read(fname)
+    os.makedirs(cachedir, exist_ok=True)
+    df.to_pickle(cache + ".tmp")
+    os.replace(cache + ".tmp", cache)
+    return df
+
+
+
+def join(power, dstat, tolerance="2s"):
+    """
+    As-of join of every power sample with the dstat line of the interval it belongs to.
+
+    dstat writes a line at the end of each interval, so the next line is taken.
+    """
+    return pandas.merge_asof(power, dstat, on="timestamp", direction="forward",
+                             tolerance=pandas.Timedelta(tolerance))
+
+
+
+def parameters(prefix):
+    """
+    Parameters of a run from its file prefix, e.g. 'sockets=4_time=3600_idle_governor=powersave'.
+
+    :rtype: dict
+    """
+    params = dict(idle=False)
+    for token in os.path.basename(prefix).split("_"):
+        name, sep, value = token.partition("=")
+        if not sep:
+            params[name] = True
+            continue
+        try:                params[name] = int(value)
+        except ValueError:
+            try:            params[name] = float(value)
+            except ValueError:  params[name] = value
+    return params
+
+
+
+def energy(t, p):
+    """Energy [J] of power samples p [W] at times t [s] by the trapezoidal rule."""
+    return float(numpy.sum(numpy.diff(t) * (p[1:] + p[:-1]) / 2)) if len(t) > 1 else 0.0
+
+
+
+def run(prefix, cachedir=None, tolerance="2s"):
+    """
+    Metrics of a run from '<prefix>_power.csv' and '<prefix>_dstat.csv'.
+
+    :returns: parameters of the run, duration [s], energy [J], mean power [W], mean CPU utilisation [%]
+              and mean power per fully utilised CPU [W]
+    :rtype: dict
+    """
+    power = cached(read_power, prefix + "_power.csv", cachedir)
+    result = parameters(prefix)
+    t = (power["timestamp"] - power["timestamp"].iloc[0]).dt.total_seconds().values if len(power) else numpy.empty(0)
+    p = power["power"].values
+    result.update(samples=len(power), duration=float(t[-1]) if len(t) else 0.0, energy=energy(t, p),
+                  power=float(p.mean()) if len(p) else float("nan"),
+                  utilisation=float("nan"), power_per_utilisation=float("nan"))
+    if os.path.exists(prefix + "_dstat.csv"):
+        dstat = cached(read_dstat, prefix + "_dstat.csv", cachedir)
+        if "utilisation" in dstat:
+            merged = join(power, dstat[["timestamp", "utilisation"]], tolerance).dropna(subset=["utilisation"])
+            util = float(merged["utilisation"].mean()) if len(merged) else float("nan")
+            result.update(utilisation=util,
+                          power_per_utilisation=float(merged["power"].mean()) / (util / 100) if util else float("nan"))
+    return result
+
+
+
+def runs(dstdir, processes=None, cachedir=None):
+    """
+    Metrics of all runs in dstdir, one process per run.
+
+    :param processes: number of worker processes, all CPUs if None
+    :type processes: int
+    :rtype: pandas.DataFrame
+    """
+    prefixes = sorted(f[:-len("_power.csv")] for f in glob.glob(os.path.join(dstdir, "*_power.csv")))
+    if not prefixes:
+        return pandas.DataFrame()
+    with Pool(min(processes or cpu_count(), len(prefixes))) as pool:
+        rows = pool.starmap(run, [(p, cachedir) for p in prefixes])
+    return pandas.DataFrame(rows)
+
+
+
+def compare(df, value="energy"):
+    """
+    Table of value with one column per governor and one row per other parameters of the runs.
+
+    Parameters missing in some runs, e.g. the workload of idle runs, are shown as '-'.
+
+    :param value: column of runs(), e.g. 'energy', 'power' or 'power_per_utilisation'
+    :type value: str
+    """
+    metrics = ("samples", "duration", "energy", "power", "utilisation", "power_per_utilisation")
+    index = [c for c in df.columns if c not in metrics and c != "governor"]
+    df = df.copy()
+    df[index] = df[index].astype(object).where(df[index].notna(), "-")
+    duplicated = df.duplicated(index + ["governor"], keep=False)
+    if duplicated.any():
+        raise Exception("Several runs with the same parameters:\n{}".format(df.loc[duplicated, index + ["governor"]]))
+    return df.set_index(index + ["governor"])[value].unstack("governor")
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(), formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("dstdir", nargs="?", default="/home/lab/frehiwot/cpufreq-governor-dstat/", help="directory of the sweep's traces")
+    parser.add_argument("-j", "--processes", type=int, help="worker processes (default: all CPUs)")
+    parser.add_argument("--cachedir", help="directory of parsed traces (default: DSTDIR/.cache)")
+    parser.add_argument("-v", "--value", action="append",
+                        choices=["energy", "power", "utilisation", "power_per_utilisation", "duration"],
+                        help="compared value, repeat for several tables (default: energy and power)")
+    parser.add_argument("-o", "--output", help="CSV file of all runs")
+    args = parser.parse_args()
+
+    df = runs(args.dstdir, args.processes, args.cachedir)
+    if df.empty:
+        print("No runs in '{}'.".format(args.dstdir))
+        return 1
+    if args.output is not None:
+        df.to_csv(args.output, index=False)
+    with pandas.option_context("display.width", 200, "display.max_columns", None):
+        for value in (args.value or ["energy", "power"]):
+            print("\n### {} ###".format(value))
+            print(compare(df, value))
+    return 0
+
+
+
+if __name__ == '__main__':
+    main()
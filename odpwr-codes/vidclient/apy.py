@@ -26,7 +26,174 @@ API for Python to control distributed things in a coherent way.
 
 
 
-import subprocess, os, time
+import subprocess, os, glob, time, tempfile, uuid, threading, collections, shutil, datetime, json, itertools, zlib, hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+###############
+### Streams ###
+###############
+
+def parse_sample(line):
+    """
+    Parse a 'timestamp,voltage,current,power' line of a power sampler.
+
+    :returns: UNIX timestamp, voltage, current and power or 'None' for header and broken lines
+    :rtype: tuple(float, float, float, float)
+    """
+    fields = line.strip().split(",")
+    if len(fields) < 4:
+        return None
+    try:
+        return (datetime.datetime.fromisoformat(fields[0]).timestamp(),
+                float(fields[1]), float(fields[2]), float(fields[3]))
+    except ValueError:
+        return None
+
+
+def parse_dstat(line):
+    """
+    Parse a line of dstat's CSV output with time and total CPU usage as first columns.
+
+    :returns: local UNIX timestamp of arrival and CPU utilisation [%] or 'None' for header lines
+    :rtype: tuple(float, float)
+    """
+    fields = line.strip().split(",")
+    try:
+        return (time.time(), 100.0 - float(fields[3]))
+    except (ValueError, IndexError):
+        return None
+
+
+class Stream:
+    """
+    Consumer of the stdout of a remote process while it is running.
+
+    :param fname: local file each line is written to
+    :type fname: str
+    :param maxlen: number of latest samples kept in memory
+    :type maxlen: int
+    :param parse: converts a line into a sample, 'None' to skip the line
+    :type parse: function
+    :param listeners: functions called with every sample as it arrives
+    :type listeners: list(function)
+    """
+    def __init__(self, fname=None, maxlen=100000, parse=None, listeners=None):
+        self.fname = fname
+        self.samples = collections.deque(maxlen=maxlen)
+        self.parse = parse
+        self.listeners = list(listeners or [])
+        self._thread, self._kill = None, None
+
+    def attach(self, pipe, head=b"", kill=None):
+        """
+        Start reading lines of pipe in background.
+
+        :param head: output of the process read from pipe before
+        :type head: bytes
+        :param kill: function terminating the process if it does not end, see save()
+        :type kill: function
+        """
+        self._kill = kill
+        self._thread = threading.Thread(target=self._consume, args=(pipe, head), daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _lines(pipe, head):
+        for l in pipe:
+            if head:
+                yield from (head + l).splitlines(keepends=True)
+                head = b""
+            else:
+                yield l
+        yield from head.splitlines(keepends=True)
+
+    def _consume(self, pipe, head):
+        f = None if self.fname is None else open(self.fname, "w", buffering=1)
+        try:
+            for l in self._lines(pipe, head):
+                l = l.decode("ascii")
+                if f is not None:
+                    f.write(l)
+                sample = l if self.parse is None else self.parse(l)
+                if sample is not None:
+                    self.samples.append(sample)
+                    for listener in self.listeners:
+                        listener(sample)
+        finally:
+            if f is not None:
+                f.close()
+
+    def join(self, timeout=None):
+        """Wait until the remote process closed its stdout."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def save(self, dst, timeout=60):
+        """
+        Copy the local file to given destination once the stream ended.
+
+        :param timeout: seconds to wait for the end before the process is killed
+        :type timeout: float
+        """
+        if self.fname is None:
+            raise Exception("Stream is not written to a file.")
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.split(self.fname)[1])
+        self.join(timeout)
+        if self._thread is not None and self._thread.is_alive():
+            if self._kill is not None:
+                self._kill()
+            self.join(timeout)
+        shutil.copyfile(self.fname, dst)
+        return 0
+
+
+# two-sided 95 % quantiles of Student's t distribution for 1 to 30 degrees of freedom
+t975 = (12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23, 2.20, 2.18, 2.16, 2.14, 2.13,
+        2.12, 2.11, 2.10, 2.09, 2.09, 2.08, 2.07, 2.07, 2.06, 2.06, 2.06, 2.05, 2.05, 2.05, 2.04)
+
+
+class BatchMeans:
+    """
+    Streaming 95 % confidence interval of the mean of an autocorrelated series,
+    e.g. power, by the method of non-overlapping batch means.
+
+    :param batch: seconds per batch, long against the correlation time of the series
+    :type batch: float
+    """
+    def __init__(self, batch=30):
+        self.batch = batch
+        self.means = []
+        self._begin, self._sum, self._n = None, 0.0, 0
+
+    def add(self, timestamp, value):
+        if value != value:      # nan
+            return
+        if self._begin is None:
+            self._begin = timestamp
+        elif timestamp - self._begin >= self.batch:
+            self.means.append(self._sum / self._n)
+            self._begin, self._sum, self._n = timestamp, 0.0, 0
+        self._sum += value
+        self._n += 1
+
+    def mean(self):
+        return sum(self.means) / len(self.means) if self.means else float("nan")
+
+    def halfwidth(self):
+        """Half width of confidence interval, infinite with less than two batches."""
+        k = len(self.means)
+        if k < 2:
+            return float("inf")
+        m = self.mean()
+        s2 = sum((x - m)**2 for x in self.means) / (k - 1)
+        return (t975[k-2] if k <= len(t975) + 1 else 1.96) * (s2 / k)**0.5
+
+    def converged(self, width, relative=True):
+        """Check whether the half width is at most width, relative to the mean or absolute."""
+        return self.halfwidth() <= width * (abs(self.mean()) if relative else 1)
 
 
 
@@ -34,6 +201,16 @@ import subprocess, os, time
 ### Machines ###
 ################
 
+def parse_cpulist(cpulist):
+    """Convert a CPU list of sysfs, e.g. '0-3,8', to a list of CPUs."""
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if part:
+            first, _, last = part.partition("-")
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
 class SshDevice:
     """
     Base class for an device controlled over SSH.
@@ -44,17 +221,28 @@ class SshDevice:
     :type password: str
     :param message: announce
     :type message: str
+    :param multiplex: share one persistent SSH connection (ControlMaster)
+                      between all calls instead of a handshake per call
+    :type multiplex: bool
 
     Class variable:
         commands = { "name" : "command"}
         --> creates name_start() and name_stop() routines
+        persist = seconds the master connection stays open after last use
+        cachedir = local directory of inventories, see inventory()
     """
     commands = {}
+    persist = 600
+    _pidmarker = b"--apy-pid--"
+    cachedir = os.path.join(os.path.expanduser("~"), ".cache", "apy")
 
-    def __init__(self, host, password=None):
+    def __init__(self, host, password=None, multiplex=True):
         self.host = host
         self.password = password
+        self.multiplex = multiplex
+        self._controlpath = os.path.join(tempfile.gettempdir(), "apy-ssh-%C")
         self._processes = dict()
+        self._inventory = None
         super().__init__()          # additional features
 
         # integrated commands from class variable
@@ -72,6 +260,21 @@ class SshDevice:
         if self._motd:
             self.rmannounce()
 
+    def _ssh(self, *args, program="ssh"):
+        """Argument list for ssh/scp, using the shared master connection if multiplexed."""
+        options = []
+        if self.multiplex:
+            options = ["-o", "ControlMaster=auto",
+                       "-o", "ControlPath={}".format(self._controlpath),
+                       "-o", "ControlPersist={}".format(self.persist)]
+        return [program] + options + list(args)
+
+    def close(self):
+        """Close the shared master connection."""
+        if self.multiplex:
+            subprocess.call(self._ssh("-O", "exit", self.host),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
     def _SSHcommand(self, command, sudo=False):
         if sudo:
             if self.password is None:
@@ -89,9 +292,34 @@ class SshDevice:
         :type kwargs: dict        :returns: stdout and stderr
         :rtype: str, str
         """
-        return subprocess.check_output(["ssh", self.host, self._SSHcommand(command, sudo=sudo)], **kwargs).decode("ascii")
+        return subprocess.check_output(self._ssh(self.host, self._SSHcommand(command, sudo=sudo)), **kwargs).decode("ascii")
+
+    def call_many(self, commands, **kwargs):
+        """
+        Execute several commands on remote device in a single round trip.
 
-    def start(self, command, sudo=False, delay=0.1, **kwargs):
+        :param commands: command strings or (command, sudo) tuples
+        :type commands: list
+        :param kwargs: additional keyword arguments for subprocess.check_output
+        :type kwargs: dict
+        :returns: exit status and stdout of each command
+        :rtype: list(tuple(int, str))
+        """
+        marker = "--apy-{}--".format(uuid.uuid4().hex)
+        script = ""
+        for c in commands:
+            command, sudo = (c, False) if isinstance(c, str) else c
+            script += "( {} ); echo {}$?\n".format(self._SSHcommand(command, sudo=sudo), marker)
+        out = subprocess.check_output(self._ssh(self.host, script), **kwargs).decode("ascii")
+        parts = out.split(marker)
+        outputs, codes = parts[:1], []
+        for part in parts[1:]:
+            code, _, output = part.partition("\n")
+            codes.append(int(code))
+            outputs.append(output)
+        return list(zip(codes, outputs))
+
+    def start(self, command, sudo=False, delay=0.1, stream=None, **kwargs):
         """
         Start command on remote device.
 
@@ -99,28 +327,62 @@ class SshDevice:
         :type sudo: bool
         :param delay: delay after getting process id to prevent connection closing befor process really started
         :type delay: float
+        :param stream: consumer of the remote process' stdout while it is running
+        :type stream: Stream
         :param kwargs: additional keyword arguments for subprocess.Popen
         :type kwargs: dict
         :returns: process id of remote process
         :rtype: int
         """
-        p =  subprocess.Popen(["ssh", self.host, "{} & echo $! && sleep {}".format(
-                    self._SSHcommand(command, sudo=sudo), delay)],
+        p =  subprocess.Popen(self._ssh(self.host, "{} & echo {}$! && sleep {}".format(
+                    self._SSHcommand(command, sudo=sudo), self._pidmarker.decode("ascii"), delay)),
                     stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                     **kwargs)
-        pid = int(p.stdout.readline())
+        # the command may write to stdout before the shell echoes its process id
+        head = b""
+        for l in iter(p.stdout.readline, b""):
+            before, marker, after = l.partition(self._pidmarker)
+            head += before
+            if marker:
+                pid = int(after)
+                break
+        else:
+            p.wait()
+            raise Exception("Failed to start '{}' on {}: {}".format(command, self.host, p.stderr.read().decode("ascii").strip()))
         self._processes[pid] = p
+        if stream is not None:
+            stream.attach(p.stdout, head, kill=lambda: (self.stop(pid), p.kill()))
         return pid
 
     def stop(self, pid):
         """Kill process of process id if still running."""
         if self._processes[pid].poll() is None:
-            subprocess.call(["ssh", self.host, "kill {}".format(pid)])
+            subprocess.call(self._ssh(self.host, "kill {}".format(pid)))
 
     def is_running(self, pid):
         """Check whether remote process is still running."""
         return self._processes[pid].poll() is None
 
+    def summary(self, pid, fname, channel=0, timeout=2):
+        """
+        Query running energy and power statistics of a sampler (see yokogawa.py --summary).
+
+        :param pid: process id of remote sampler, a finished one left its final statistics
+        :type pid: int
+        :param fname: remote summary file of the sampler
+        :type fname: str
+        :param timeout: seconds to wait for the sampler to rewrite the file
+        :type timeout: float
+        :returns: number of samples, duration [s], energy [J], mean, variance, min, max and quantiles of power [W]
+        :rtype: dict
+        """
+        # the sampler replaces the file: wait until inode, mtime or size change
+        out = self.call("f={1}; old=$(stat -c '%i %y %s' $f 2>/dev/null); "
+                        "kill -USR1 {0} 2>/dev/null && for i in $(seq {2}); do "
+                        "[ \"$(stat -c '%i %y %s' $f 2>/dev/null)\" != \"$old\" ] && break; sleep 0.01; done; "
+                        "cat $f".format(pid, fname, int(timeout / 0.01)))
+        return json.loads(out)[channel]
+
     def get_output(self, pid):
         """Return stdout and stderr of finished processes."""
         if self.is_running(pid):
@@ -133,8 +395,77 @@ class SshDevice:
             stdout += l.decode("ascii")
         return stdout, stderr
 
+    def download(self, *files, compress=True, resume=True):
+        """
+        Download remote files concurrently over the shared connection.
+
+        Data are gzip-compressed on the remote side and appended to '<dst>.part',
+        so an interrupted download continues where it stopped. The file is
+        renamed to dst only if its SHA-256 matches the remote file's.
+
+        :param files: (remote source, local destination) tuples
+        :type files: tuple(str, str)
+        :param compress: compress during the transfer
+        :type compress: bool
+        :param resume: continue a partial download, otherwise start from the beginning
+        :type resume: bool
+        :returns: 0 if all files were downloaded, exit status of a failed transfer otherwise
+        :rtype: int
+        """
+        if not files:
+            return 0
+        with ThreadPoolExecutor(max_workers=len(files)) as pool:
+            codes = list(pool.map(lambda f: self._fetch(f[0], f[1], compress, resume), files))
+        return max(codes, key=abs)
+
+    def _fetch(self, src, dst, compress, resume, attempts=2):
+        part = dst + ".part"
+        if not resume and os.path.exists(part):
+            os.remove(part)
+        (code, size), (_, checksum) = self.call_many(["stat -c %s {}".format(src), "sha256sum {}".format(src)])
+        if code != 0:
+            return code             # missing source: leave no part file behind
+        size, checksum = int(size), checksum.split()[0]
+        for attempt in range(attempts):
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if offset > size:
+                os.remove(part)
+                offset = 0
+            command = "tail -c +{} {}".format(offset + 1, src) + (" | gzip -1" if compress else "")
+            process = subprocess.Popen(self._ssh(self.host, command), stdout=subprocess.PIPE)
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if compress else None
+            try:
+                with open(part, "ab") as f:
+                    for chunk in iter(lambda: process.stdout.read(1 << 16), b""):
+                        f.write(decompressor.decompress(chunk) if compress else chunk)
+                    if compress:
+                        f.write(decompressor.flush())
+            except zlib.error:
+                # corrupt stream: start again
+                process.kill()
+                process.wait()
+                os.remove(part)
+                continue
+            if process.wait() != 0:
+                if os.path.getsize(part) == 0:
+                    os.remove(part)
+                return process.returncode       # keep the partial file to resume
+            digest = hashlib.sha256()
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+            if digest.hexdigest() == checksum:
+                os.replace(part, dst)
+                return 0
+            # the remote file differs from the resumed part: start again
+            os.remove(part)
+        return 1
+
     def announce(self, msg="Frehiwot Konjo"):
-        self.call("echo {} > /tmp/measrun".format(msg))
+        self.call(self._announce_command(msg))
+
+    def _announce_command(self, msg):
+        return "echo {} > /tmp/measrun".format(msg)
 
     def rmannounce(self):
         try:    self.call("rm /tmp/measrun")
@@ -157,15 +488,122 @@ class SshDevice:
             if critical:    raise e
         return out
 
+    # files of each CPU in /sys/devices/system/cpu/cpu*/ collected by inventory()
+    _inventory_files = ("online", "topology/physical_package_id", "topology/core_id", "topology/thread_siblings_list",
+                        "cpufreq/scaling_driver", "cpufreq/scaling_available_governors",
+                        "cpufreq/scaling_available_frequencies", "cpufreq/cpuinfo_min_freq", "cpufreq/cpuinfo_max_freq")
+
+    def inventory(self, refresh=False):
+        """
+        System inventory: kernel, logical CPUs with topology and cpufreq capabilities.
+
+        It is discovered in one round trip, which includes the boot id, and
+        stored locally per host and boot id, so later calls and runs only
+        query the boot id.
+
+        :param refresh: discover again even if stored
+        :type refresh: bool
+        :returns: host, boot_id, kernel, cpus (dict per logical CPU with cpu, online, package, core,
+                  siblings, driver, governors, frequencies [kHz], min, max), sockets (package: CPUs)
+                  and governors available on all online CPUs
+        :rtype: dict
+        """
+        if self._inventory is not None and not refresh:
+            return self._inventory
+        stored = glob.glob(os.path.join(glob.escape(self.cachedir), "{}_*.json".format(glob.escape(self.host))))
+        if stored and not refresh:
+            # only a stored inventory needs the boot id beforehand
+            boot_id = self.call("cat /proc/sys/kernel/random/boot_id").strip()
+            fname = os.path.join(self.cachedir, "{}_{}.json".format(self.host, boot_id))
+            if os.path.exists(fname):
+                with open(fname) as f:
+                    self._inventory = json.load(f)
+                return self._inventory
+
+        results = self.call_many(["cat /proc/sys/kernel/random/boot_id", "uname -r",
+                                  "cd /sys/devices/system/cpu && grep -H . " +
+                                  " ".join("cpu[0-9]*/" + f for f in self._inventory_files) + " 2>/dev/null"])
+        boot_id = results[0][1].strip()
+        fname = os.path.join(self.cachedir, "{}_{}.json".format(self.host, boot_id))
+        values = collections.defaultdict(dict)
+        for l in results[2][1].splitlines():
+            path, _, value = l.partition(":")
+            cpu, _, name = path.partition("/")
+            values[int(cpu[3:])][name] = value.strip()
+        cpus = []
+        for (c, v) in sorted(values.items()):
+            number = lambda name: int(v[name]) if name in v else None
+            cpus.append(dict(cpu=c, online=v.get("online", "1") == "1",
+                             package=number("topology/physical_package_id"), core=number("topology/core_id"),
+                             siblings=parse_cpulist(v.get("topology/thread_siblings_list", str(c))),
+                             driver=v.get("cpufreq/scaling_driver"),
+                             governors=v.get("cpufreq/scaling_available_governors", "").split(),
+                             frequencies=[int(f) for f in v.get("cpufreq/scaling_available_frequencies", "").split()],
+                             min=number("cpufreq/cpuinfo_min_freq"), max=number("cpufreq/cpuinfo_max_freq")))
+        online = [c for c in cpus if c["online"]]
+        sockets = collections.defaultdict(list)
+        for c in online:
+            sockets[str(c["package"])].append(c["cpu"])
+        governors = set(online[0]["governors"]) if online else set()
+        for c in online:
+            governors &= set(c["governors"])
+        self._inventory = dict(host=self.host, boot_id=boot_id, kernel=results[1][1].strip(),
+                               cpus=cpus, sockets=dict(sockets), governors=sorted(governors))
+        os.makedirs(self.cachedir, exist_ok=True)
+        with open(fname + ".tmp", "w") as f:
+            json.dump(self._inventory, f, indent=1)
+        os.replace(fname + ".tmp", fname)
+        return self._inventory
+
+    def validate(self, governor=None, cpus=None):
+        """
+        Check that CPUs are online and governor is available on them, before a run starts.
+
+        :param cpus: logical CPUs, all online ones if None
+        :type cpus: list(int)
+        :returns: checked CPUs
+        :rtype: list(int)
+        """
+        inventory = self.inventory()
+        known = {c["cpu"]: c for c in inventory["cpus"]}
+        if cpus is None:
+            cpus = [c for c in sorted(known) if known[c]["online"]]
+        for c in cpus:
+            if c not in known or not known[c]["online"]:
+                raise Exception("CPU {} of {} is not online.".format(c, self.host))
+            if governor is not None and governor not in known[c]["governors"]:
+                raise Exception("Governor '{}' is not available on CPU {} of {} ({}).".format(
+                        governor, c, self.host, " ".join(known[c]["governors"]) or "no cpufreq"))
+        return list(cpus)
+
     def set_governor(self, governor, cpus=None):
         """Set governor to each logical CPU."""
-        if cpus is None:
-            if not hasattr(self, "cpus"):
-                self.cpus = int(self.call("grep -c ^processor /proc/cpuinfo"))
-            self.call("for i in $(seq 0 1 {}); do echo {} > /sys/devices/system/cpu/cpu$i/cpufreq/scaling_governor; done".format(self.cpus-1, governor), sudo=True)
-            return
-        for cpu in cpus:
-            self.call("echo {} > /sys/devices/system/cpu/cpu{}/cpufreq/scaling_governor".format(governor, cpu), sudo=True)
+        self.call(self._governor_command(governor, cpus), sudo=True)
+
+    def _governor_command(self, governor, cpus):
+        cpus = self.validate(governor, cpus)
+        return "for i in {}; do echo {} > /sys/devices/system/cpu/cpu$i/cpufreq/scaling_governor; done".format(
+                " ".join(str(c) for c in cpus), governor)
+
+    def setup(self, msg="Frehiwot Konjo", server="ntp.ubuntu.com", critical=True,
+              governor=None, cpus=None):
+        """
+        Announce, synchronize system time and optionally set governor in one round trip.
+
+        :param critical: raise exception on non-zero exit status of ntpdate
+        :type critical: bool
+        :returns: output of ntpdate call, 'None' if an error occured
+        :rtype: str
+        """
+        commands = [self._announce_command(msg), ("ntpdate {}".format(server), True)]
+        if governor is not None:
+            commands.append((self._governor_command(governor, cpus), True))
+        results = self.call_many(commands)
+        for (command, (code, output)) in zip(commands, results):
+            if code != 0 and (command is not commands[1] or critical):
+                raise subprocess.CalledProcessError(code, command if isinstance(command, str) else command[0], output)
+        code, out = results[1]
+        return out if code == 0 else None
 
 
 class FeatureDstat:
@@ -174,13 +612,20 @@ class FeatureDstat:
         super().__init__()
 
     def dstat_start(self, user="markus", prefix="pyAPI",
-                    datetime=None):
+                    datetime=None, listeners=None):
+        """
+        :param listeners: functions called with (timestamp, CPU utilisation) while dstat is running
+        :type listeners: list(function)
+        """
         if self._dstat is not None:
             self.stop(self._dstat)
         self._dstat_fname = os.path.join("/home/odroid/Documents/odroidtranscoding/dstat/",
                 "{}_{}.csv".format(prefix,
                 time.strftime("%Y-%m-%d_%H-%M-%S") if datetime is None else datetime))
         self._dstat = self.start("dstat -tclmndN eth1,eth2 --output {}".format(self._dstat_fname))
+        if listeners:
+            self.start("tail --pid={} -n +1 -F {} 2>/dev/null".format(self._dstat, self._dstat_fname),
+                       stream=Stream(parse=parse_dstat, listeners=listeners))
 
     def dstat_stop(self):
         self.stop(self._dstat)
@@ -192,53 +637,135 @@ class FeatureDstat:
             raise Exception("There is no file to download.")
         if os.path.isdir(dst):
             dst = os.path.join(dst, os.path.split(self._dstat_fname)[1])
-        return subprocess.call(["scp", "{}:{}".format(self.host, self._dstat_fname), dst])
+        return self.download((self._dstat_fname, dst))
+
+
+class FeatureSysmon:
+    """Feature of lean sampler of procfs and sysfs counters and CPU frequencies (vidserver/sysmon.py)."""
+    def __init__(self):
+        self._sysmon, self._sysmon_fname, self._sysmon_last = None, None, None
+        super().__init__()
+
+    def sysmon_start(self, rate=1, prefix="pyAPI", datetime=None, net=("eth1", "eth2")):
+        """
+        :param rate: samples per second
+        :type rate: float
+        :param net: network interfaces, all if None
+        :type net: list(str)
+        """
+        if self._sysmon is not None:
+            self.stop(self._sysmon)
+        self._sysmon_fname = os.path.join("/home/odroid/Documents/odroidtranscoding/sysmon/",
+                "{}_{}.bin".format(prefix,
+                time.strftime("%Y-%m-%d_%H-%M-%S") if datetime is None else datetime))
+        command = "/home/odroid/Documents/vidserver/sysmon.py -r {} -f {}".format(rate, self._sysmon_fname)
+        if net:
+            command += " -N {}".format(",".join(net))
+        self._sysmon = self.start(command)
+
+    def sysmon_stop(self):
+        self.stop(self._sysmon)
+        self._sysmon_last, self._sysmon = self._sysmon, None
+
+    def sysmon_overhead(self, timeout=10):
+        """Return the report of the last stopped sampler on its own CPU usage."""
+        if self._sysmon_last is None:
+            raise Exception("There is no stopped sampler.")
+        self._processes[self._sysmon_last].wait(timeout)
+        return self.get_output(self._sysmon_last)[1].strip().splitlines()[-1]
+
+    def sysmon_save(self, dst):
+        """Download the remote file to given local destination."""
+        if self._sysmon_fname is None:
+            raise Exception("There is no file to download.")
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.split(self._sysmon_fname)[1])
+        return self.download((self._sysmon_fname, dst))
 
 
 class FeatureWT230:
     """Feature of old power sampling script."""
     def __init__(self):
         self._wt230, self._wt230_fname = None, None
+        self._wt230_stream, self._wt230_tail, self._wt230_summary = None, None, None
         super().__init__()
 
-    def WT230_start(self, mode="230V", user="frehiwot", prefix="pyAPI", datetime=None):
+    def WT230_start(self, mode="230V", user="frehiwot", prefix="pyAPI", datetime=None,
+                    stream=False, summary=False, listeners=None):
         """
         :param mode: '230V' or '12V'
         :type mode: str
+        :param stream: follow the remote file while sampling instead of downloading it afterwards
+        :type stream: bool
+        :param listeners: functions called with every sample (timestamp, voltage, current, power) of the stream
+        :type listeners: list(function)
+        :param summary: keep running statistics on the sampler, see WT230_summary()
+        :type summary: bool
         """
-        if self._wt230 is not None:
-            self.stop(self._wt230)
+        for pid in (self._wt230, self._wt230_tail):
+            if pid is not None:
+                self.stop(pid)
         self._wt230_fname = os.path.join("/home/lab", user, "power",
                 "{}_{}.csv".format(prefix,
                 time.strftime("%Y-%m-%d_%H-%M-%S") if datetime is None else datetime))
         self._wt230 = self.start("WT230 -u {} -p {} -t {} -m {}".format(user, prefix,
                 time.strftime("%Y-%m-%d_%H-%M-%S") if datetime is None else datetime,
                 mode))
+        self._wt230_stream, self._wt230_tail = None, None
+        if stream:
+            # WT230 only writes to its file: tail it until WT230 has finished
+            self._wt230_stream = Stream(os.path.join(tempfile.gettempdir(), os.path.split(self._wt230_fname)[1]),
+                                        parse=parse_sample, listeners=listeners)
+            self._wt230_tail = self.start("tail --pid={} -n +1 -F {} 2>/dev/null".format(self._wt230, self._wt230_fname),
+                                          stream=self._wt230_stream)
+        self._wt230_summary = None
+        if summary:
+            # WT230 has no statistics: feed its file to yokogawa
+            self._wt230_summary = (self.start("tail --pid={} -n +1 -F {} 2>/dev/null | yokogawa --csv-input -d {} -f /dev/null -s {}.summary".format(
+                                        self._wt230, self._wt230_fname, os.path.dirname(self._wt230_fname), self._wt230_fname)),
+                                   self._wt230_fname + ".summary")
 
     def WT230_stop(self):
         self.stop(self._wt230)
         self._wt230 = None
 
+    def WT230_samples(self):
+        """Return latest samples of a streamed measurement."""
+        if self._wt230_stream is None:
+            raise Exception("There is no streamed measurement.")
+        return list(self._wt230_stream.samples)
+
+    def WT230_summary(self):
+        """Return energy and power statistics of the current or last measurement."""
+        if self._wt230_summary is None:
+            raise Exception("There are no statistics, start the measurement with summary=True.")
+        return self.summary(*self._wt230_summary)
+
     def WT230_save(self, dst):
         """Download the remote file to given local destination."""
+        if self._wt230_stream is not None:
+            return self._wt230_stream.save(dst)
         if self._wt230_fname is None:
             raise Exception("There is no file to download.")
         if os.path.isdir(dst):
             dst = os.path.join(dst, os.path.split(self._wt230_fname)[1])
-        return subprocess.call(["scp", "{}:{}".format(self.host, self._wt230_fname), dst])
+        return self.download((self._wt230_fname, dst))
 
 
 class FeatureYokogawa:
     """Feature of old power sampling script."""
     def __init__(self):
         self._yokogawa, self._yokogawa_fname = None, None
+        self._yokogawa_stream, self._yokogawa_summary = None, None
         super().__init__()
 
     def yokogawa_start(self, mode="230V",
-                        dir="/home/lab/frehiwot/power", file=None):
+                        dir="/home/lab/frehiwot/power", file=None, stream=False):
         """
         :param mode: '230V, '12V' or '5V'
         :type mode: str
+        :param stream: receive samples over stdout while sampling instead of writing a remote file
+        :type stream: bool
         """
         if self._yokogawa is not None:
             self.stop(self._yokogawa)
@@ -246,25 +773,46 @@ class FeatureYokogawa:
         if file is None:
             file = "{}.csv".format(time.strftime("%Y-%m-%d_%H-%M-%S"))
         self._yokogawa_fname = os.path.join(dir, file)
-        self._yokogawa = self.start("yokogawa -m {} -d {} -f {}".format(mode, dir, file))
+        summary = self._yokogawa_fname + ".summary"
+        self._yokogawa_stream = None
+        if stream:
+            self._yokogawa_stream = Stream(os.path.join(tempfile.gettempdir(), file), parse=parse_sample)
+            self._yokogawa = self.start("yokogawa -m {} -f - -s {}".format(mode, summary), stream=self._yokogawa_stream)
+        else:
+            self._yokogawa = self.start("yokogawa -m {} -d {} -f {} -s {}".format(mode, dir, file, summary))
+        self._yokogawa_summary = (self._yokogawa, summary)
 
     def yokogawa_stop(self):
         self.stop(self._yokogawa)
         self._yokogawa = None
 
+    def yokogawa_samples(self):
+        """Return latest samples of a streamed measurement."""
+        if self._yokogawa_stream is None:
+            raise Exception("There is no streamed measurement.")
+        return list(self._yokogawa_stream.samples)
+
+    def yokogawa_summary(self):
+        """Return energy and power statistics of the current or last measurement."""
+        if self._yokogawa_summary is None:
+            raise Exception("There are no statistics.")
+        return self.summary(*self._yokogawa_summary)
+
     def yokogawa_save(self, dst):
         """Download the remote file to given local destination."""
+        if self._yokogawa_stream is not None:
+            return self._yokogawa_stream.save(dst)
         if self._yokogawa_fname is None:
             raise Exception("There is no file to download.")
         if os.path.isdir(dst):
             dst = os.path.join(dst, os.path.split(self._yokogawa_fname)[1])
-        return subprocess.call(["scp", "{}:{}".format(self.host, self._yokogawa_fname), dst])
+        return self.download((self._yokogawa_fname, dst))
 
 
 
-class VidServer(SshDevice, FeatureDstat):
+class VidServer(SshDevice, FeatureDstat, FeatureSysmon):
     """
-    SshDevice for the vidserver with integrated Dstat and IntelPCM.
+    SshDevice for the vidserver with integrated Dstat, sysmon and IntelPCM.
     """
     def __init__(self):
         super().__init__(host="141.76.41.124", password="wireless")
@@ -282,6 +830,142 @@ class PwrSmplr(SshDevice, FeatureWT230, FeatureYokogawa):
         super().__init__(("141.76.41.125", "141.76.41.126")[number-1], password="wireless")
 
 
+#####################
+### Orchestration ###
+#####################
+
+def gather(*calls):
+    """
+    Run calls concurrently, e.g. on different devices, and wait for all of them.
+
+    All calls are released at the same moment to keep the skew between
+    e.g. the start of power and dstat traces small.
+
+    :param calls: callables without arguments (use functools.partial for arguments)
+    :type calls: callable
+    :returns: return values in order of calls
+    :rtype: list
+    """
+    if not calls:
+        return []
+    barrier = threading.Barrier(len(calls))
+    def run(call):
+        barrier.wait()
+        return call()
+    with ThreadPoolExecutor(max_workers=len(calls)) as pool:
+        futures = [pool.submit(run, c) for c in calls]
+        return [f.result() for f in futures]
+
+
+
+
+def wait_converged(conditions, tmin, tmax, poll=10):
+    """
+    Sleep at least tmin and at most tmax seconds, but return as soon as all conditions hold.
+
+    :param conditions: callables without arguments, e.g. BatchMeans.converged with functools.partial
+    :type conditions: list(callable)
+    :returns: seconds slept
+    :rtype: float
+    """
+    start = time.monotonic()
+    time.sleep(tmin)
+    while True:
+        elapsed = time.monotonic() - start
+        if elapsed >= tmax or all(c() for c in conditions):
+            return elapsed
+        time.sleep(min(poll, tmax - elapsed))
+
+
+
+##############
+### Sweeps ###
+##############
+
+class Sweep:
+    """
+    Resumable sweep over a declarative grid of parameters.
+
+    The status of every point is kept in a JSON state file, which is
+    rewritten atomically after each change. A point is skipped if it is
+    done and all its result files exist, so an interrupted sweep continues
+    with the first point that has not been finished. Points that were
+    running or failed are measured again.
+
+    :param grid: dict of parameter name and list of values, or list of such dicts whose points are concatenated
+    :type grid: dict
+    :param statefile: local path of state file
+    :type statefile: str
+    :param files: function of a point's parameters returning its local result files
+    :type files: callable
+    """
+
+    def __init__(self, grid, statefile, files=None):
+        self.grid = [grid] if isinstance(grid, dict) else list(grid)
+        self.statefile = statefile
+        self.files = files
+        self.state = dict()
+        if os.path.exists(statefile):
+            with open(statefile) as f:
+                self.state = json.load(f)
+
+    def points(self):
+        """All points of the grid in order, as dicts of parameters."""
+        for g in self.grid:
+            names = list(g)
+            for values in itertools.product(*(g[n] for n in names)):
+                yield dict(zip(names, values))
+
+    @staticmethod
+    def key(point):
+        return json.dumps(point, sort_keys=True)
+
+    def status(self, point):
+        return self.state.get(self.key(point), dict()).get("status")
+
+    def done(self, point):
+        """Check whether point was finished and its results are still there."""
+        if self.status(point) != "done":
+            return False
+        return self.files is None or all(os.path.isfile(f) and os.path.getsize(f) > 0 for f in self.files(**point))
+
+    def pending(self):
+        return [p for p in self.points() if not self.done(p)]
+
+    def _set(self, point, status, **kwargs):
+        entry = self.state.setdefault(self.key(point), dict(params=point))
+        entry.update(status=status, **kwargs)
+        tmp = self.statefile + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.statefile)
+
+    def run(self, measure):
+        """
+        Measure every pending point.
+
+        A failing point is recorded with its error before the exception is
+        passed on.
+
+        :param measure: function called with the parameters of a point as keyword arguments
+        :type measure: callable
+        """
+        points = list(self.points())
+        for (i, point) in enumerate(points):
+            if self.done(point):
+                print("Skip {}/{}: {}".format(i+1, len(points), self.key(point)))
+                continue
+            print("Run {}/{}: {}".format(i+1, len(points), self.key(point)))
+            self._set(point, "running", started=time.time(), finished=None, error=None)
+            try:
+                measure(**point)
+            except BaseException as e:
+                self._set(point, "failed", finished=time.time(), error=repr(e))
+                raise
+            self._set(point, "done", finished=time.time())
+
+
+
 ######################
 ### Local commands ###
 ######################
@@ -293,3 +977,26 @@ def announce(msg="Frehiwot Konjo"):
 def rmannounce():
     os.remove("/tmp/measrun")
 
+def benchmark(host, n=20, command="true"):
+    """
+    Compare the latency of remote calls with a persistent multiplexed
+    connection against one SSH handshake per call.
+
+    :param host: user@address or SSH agent's host name, e.g. 'localhost'
+    :type host: str
+    :param n: number of calls per variant
+    :type n: int
+    :returns: mean seconds per call for each variant
+    :rtype: dict
+    """
+    result = dict()
+    for multiplex in (False, True):
+        device = SshDevice(host, multiplex=multiplex)
+        device.call(command)        # warm up (opens master connection)
+        t = time.monotonic()
+        for i in range(n):
+            device.call(command)
+        result["multiplex" if multiplex else "fork"] = (time.monotonic() - t) / n
+        device.close()
+    return result
+
@@ -27,6 +27,7 @@ Measurement of power consumption of vidserver depending on cpufreq-governor.
 
 import apy
 import time, os
+from functools import partial
 
 
 # Config
@@ -40,16 +41,46 @@ sockets = { #1 : list(range(4)),         # governor will be set for all vCPU inc
             #3 : list(range(12)),
             4 : list(range(16)),
         }
-#governors = ("performance", "powersave", "conservative", "ondemand")
+#governors = ("performance", "powersave", "conservative", "ondemand", "wlgen")    # wlgen: userspace with wlgov.py
 governors = ("powersave", )
+# stop a point after at least tmin seconds once the 95 % confidence interval of mean power is
+# within +-width of the mean (and of CPU utilisation within +-util percent points if not None),
+# at the latest after the workload's time; None to always measure the workload's time
+#adaptive = dict(width=0.01, tmin=600, batch=30, util=None)
+adaptive = None
 
 
 
 class VidServer(apy.VidServer):
+    # wlgen's state of transcodings per CPU, read by governor daemon wlgov.py
+    statefile = "/dev/shm/wlgen.state"
+    # running transcodings per CPU under wlgov.py, so that further ones wait and their delay drives the frequency
+    inflight = 1
+
     def __init__(self):
         self._workload = None
+        self._wlgov = None
         super().__init__()
 
+    def set_governor(self, governor, cpus=None):
+        """Set a governor of the kernel or 'wlgen' for governor userspace controlled by wlgov.py."""
+        self.wlgov_stop()
+        if governor != "wlgen":
+            return super().set_governor(governor, cpus)
+        super().set_governor("userspace", cpus)
+        command = "/home/odroid/Documents/vidserver/wlgov.py --state {}".format(self.statefile)
+        if cpus is not None:
+            command += " --cpus {}".format(",".join(str(c) for c in cpus))
+        self._wlgov = self.start(command, sudo=True)
+
+    def validate(self, governor=None, cpus=None):
+        return super().validate("userspace" if governor == "wlgen" else governor, cpus)
+
+    def wlgov_stop(self):
+        if self._wlgov is not None and self.is_running(self._wlgov):
+            self.call("kill {}".format(self._wlgov), sudo=True)     # runs as root
+        self._wlgov = None
+
     def workload_start(self, wait=None, vmax=None, cpus=None, uvmin=None, **trash):
         if self._workload is not None:
             self.stop(self._workload)
@@ -57,6 +88,7 @@ class VidServer(apy.VidServer):
         if wait is not None:    command += " --wait {}".format(wait)
         if vmax is not None:    command += " --vmax {}".format(vmax)
         if uvmin is not None:   command += " --uvmin {}".format(uvmin)
+        if self._wlgov is not None: command += " --state {} --inflight {}".format(self.statefile, self.inflight)
         if cpus is not None:
             command += " --cpus {}".format(cpus[0])
             for c in cpus[1:]:
@@ -70,53 +102,82 @@ class VidServer(apy.VidServer):
 
 
 
+def prefix(workload, s, governor):
+    prefix = "sockets={}_time={}_".format(s, workload["time"])
+    if workload.get("idle"):
+        return prefix + "idle_governor={}".format(governor)
+    return prefix + "wait={wait}_uvmin={uvmin}_vmax={vmax}_governor={g}".format(g=governor, **workload)
+
+
+
+def files(workload, s, governor):
+    return [os.path.join(dstdir, "{}_{}.csv".format(prefix(workload, s, governor), t)) for t in ("power", "dstat")]
+
+
+
 def main():
 
     apy.announce()
     vidserver = VidServer()
-    vidserver.announce()
-    vidserver.ntpdate()
     power = apy.PwrSmplr(1)
-    power.announce()
-    power.ntpdate(critical=False) #???
-
-    for wl in workloads:
-        idle = "idle" in wl and wl["idle"]
-        for (s, cpus) in sockets.items():
-            for governor in governors:
-
-                # configure
-                vidserver.set_governor(governor)
-
-                # start
-                if not idle:
-                    vidserver.workload_start(cpus=cpus, **wl)
-                vidserver.dstat_start()
-                power.WT230_start()
-
-                # measure
-                time.sleep(wl["time"])
-
-                # stop
-                power.WT230_stop()
-                vidserver.dstat_stop()
-                if not idle:
-                    vidserver.workload_stop()
-                    vidserver.call("pkill ffmpeg || echo")      # ???
-
-                # get files
-                prefix = "sockets={}_time={}_".format(s, wl["time"])
-                prefix += "idle_governor={}".format(governor) if idle \
-                            else "wait={wait}_uvmin={uvmin}_vmax={vmax}_governor={g}".format(g=governor, **wl)
-                power.WT230_save(os.path.join(dstdir, "{}_power.csv".format(prefix)))
-                vidserver.dstat_save(os.path.join(dstdir, "{}_dstat.csv".format(prefix)))
-
-            # skip different sockets (used only by workload) on idle
-            if idle:    break
-
-    vidserver.rmannounce()
-    power.rmannounce()
+    apy.gather(vidserver.setup, partial(power.setup, critical=False)) #???
+    # fail now instead of hours into the sweep
+    for cpus in sockets.values():
+        for governor in governors:
+            vidserver.validate(governor, cpus)
+
+    def measure(workload, s, governor):
+        idle = workload.get("idle", False)
+
+        # configure
+        vidserver.set_governor(governor)
+
+        # start
+        if not idle:
+            vidserver.workload_start(cpus=sockets[s], **workload)
+        if adaptive is None:
+            apy.gather(vidserver.dstat_start, partial(power.WT230_start, summary=True))
+        else:
+            # batch means of power and utilisation while streaming the traces
+            watt, util = apy.BatchMeans(adaptive["batch"]), apy.BatchMeans(adaptive["batch"])
+            conditions = [partial(watt.converged, adaptive["width"])]
+            if adaptive["util"] is not None:
+                conditions.append(partial(util.converged, adaptive["util"], relative=False))
+            apy.gather(partial(vidserver.dstat_start, listeners=None if adaptive["util"] is None else [lambda s: util.add(*s)]),
+                       partial(power.WT230_start, stream=True, summary=True, listeners=[lambda s: watt.add(s[0], s[3])]))
+
+        # measure
+        if adaptive is None:
+            time.sleep(workload["time"])
+        else:
+            elapsed = apy.wait_converged(conditions, min(adaptive["tmin"], workload["time"]), workload["time"])
+            print("Measured {:.0f} s: {:.2f} +- {:.2f} W".format(elapsed, watt.mean(), watt.halfwidth()))
+
+        # stop
+        apy.gather(power.WT230_stop, vidserver.dstat_stop)
+        if not idle:
+            vidserver.workload_stop()
+            vidserver.call("pkill ffmpeg || echo")      # ???
+
+        # get files
+        (power_csv, dstat_csv) = files(workload, s, governor)
+        apy.gather(partial(power.WT230_save, power_csv),
+                   partial(vidserver.dstat_save, dstat_csv))
+
+    # sockets are used only by the workload, so idle is measured with the first one
+    grid = [dict(workload=[w for w in workloads if not w.get("idle")], s=list(sockets), governor=governors),
+            dict(workload=[w for w in workloads if w.get("idle")], s=list(sockets)[:1], governor=governors)]
+    sweep = apy.Sweep(grid, os.path.join(dstdir, "sweep.json"), files=files)
+    try:
+        sweep.run(measure)
+    finally:
+        # the daemon runs as root and keeps pinning frequencies otherwise
+        vidserver.wlgov_stop()
+
+    apy.gather(vidserver.rmannounce, power.rmannounce)
     apy.rmannounce()
+    vidserver.close()
+    power.close()
 
     return 0
 
@@ -5,31 +5,64 @@ Categorize and find videos into database.
 """
 
 import sqlite3, os, glob
-import random
+import random, time, json, subprocess, shutil
+from multiprocessing import Pool
+
+
+# relative decoding effort per pixel
+codec_factor = {"h264": 1.0, "hevc": 2.0, "vp9": 1.8, "vp8": 0.9, "mpeg4": 0.6, "mpeg2video": 0.5}
+
+
+def probe(fname):
+    """
+    Read metadata of the first video stream with ffprobe.
+
+    :param fname: path of video
+    :type fname: str
+    :returns: duration [s], bit rate [bit/s], width, height and codec, None if unknown
+    :rtype: tuple(float, int, int, int, str)
+    """
+    try:
+        out = subprocess.check_output(["ffprobe", "-v", "error", "-select_streams", "v:0", "-of", "json",
+                                       "-show_entries", "format=duration,bit_rate:stream=codec_name,width,height", fname])
+    except (OSError, subprocess.CalledProcessError):
+        return (None,) * 5
+    info = json.loads(out.decode())
+    fmt = info.get("format", {})
+    stream = (info.get("streams") or [{}])[0]
+    def number(value, t):
+        try:                            return t(value)
+        except (TypeError, ValueError): return None
+    return (number(fmt.get("duration"), float), number(fmt.get("bit_rate"), int),
+            stream.get("width"), stream.get("height"), stream.get("codec_name"))
+
+
+def cost(duration, width, height, codec):
+    """Predicted transcoding cost in megapixel seconds, None if unknown."""
+    if None in (duration, width, height):
+        return None
+    return duration * width * height / 1e6 * codec_factor.get(codec, 1.0)
+
 
 class BaseDatabase(object):
     """
     Base class for file databases.
 
-    :param dbfile: path to database file.
+    :param dbfile: path to database file, kept and reused between runs.
     :type dbfile: str
     :param quiet: If True, overwrite an existing database file.
     :type quiet: bool
     """
 
     def __init__(self, dbfile=":memory:", quiet=False):
-        """Returns True if new database was created and new tables are needed."""
 
-        # check existing file
-        i = None
-        if os.path.exists(dbfile):
-            i = input("Database file still exists. Append [a], reset [r] or quit [q]? ")
-            if i == "r" or quiet:    os.remove(dbfile)
-            elif i != "a":  return None
+        # reset existing file
+        if quiet and os.path.exists(dbfile):
+            os.remove(dbfile)
 
         # connect to file
+        self.dbfile = dbfile
         self.conn = sqlite3.connect(dbfile)
-        return i != "a"
 
 
     def print(self, query, *args):
@@ -46,36 +79,139 @@ class videos(BaseDatabase):
     """
     :param path: directory and pattern to search for videos
     :type path: str
+    :param probe: read metadata of new and changed videos with ffprobe
+    :type probe: bool
     """
-    def __init__(self, path="/home/odroid/Documents/videos/*.mp4", **kwargs):
+    def __init__(self, path="/home/odroid/Documents/videos/*.mp4", probe=True, **kwargs):
+        super().__init__(**kwargs)
+        self.probe = probe
+
+        # catalogue of an older version without file state or metadata
+        columns = [c[1] for c in self.conn.execute("PRAGMA table_info(videos)")]
+        if columns and "cost" not in columns:
+            self.conn.execute("DROP TABLE videos")
+
+        self.conn.execute("CREATE TABLE IF NOT EXISTS videos (vid INT PRIMARY KEY, fname TEXT UNIQUE, size INT, bytes INT, mtime INT, "
+                          "duration REAL, bitrate INT, width INT, height INT, codec TEXT, cost REAL, probed INT)")
+        if columns and "cost" in columns and "probed" not in columns:
+            self.conn.execute("ALTER TABLE videos ADD COLUMN probed INT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS videos_size ON videos (size)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS videos_cost ON videos (cost)")
+        self.update(path)
 
-        if super().__init__(**kwargs):    # Create Table
-            self.conn.execute("CREATE TABLE videos (vid INT PRIMARY KEY, fname TEXT, size INT)")
 
-        # insert values
+    def update(self, path):
+        """
+        Synchronize catalogue with the files matching path.
+        Only new, changed and removed files are written and probed.
+        A file ffprobe fails on is probed again only if it changes.
+
+        :param path: directory and pattern to search for videos
+        :type path: str
+        :returns: number of added or changed and of removed videos
+        :rtype: tuple(int, int)
+        """
+
+        # probe videos again which were cataloged without ffprobe
+        probing = self.probe and shutil.which("ffprobe") is not None
+        known = {f: (b, m) if p or not probing else None
+                 for (f, b, m, p) in self.conn.execute("SELECT fname, bytes, mtime, probed FROM videos")}
+        changed = []
         for f in glob.glob(path):
+            st = os.stat(f)
+            if known.pop(f, None) == (st.st_size, st.st_mtime_ns):
+                continue
             fname = os.path.split(f)[1]
             vid, size = os.path.splitext(fname)[0].split("_")
-            vid, size = int(vid), int(size)
-            #print(vid, fname, size)
-            self.conn.execute("INSERT INTO videos(fname, size) VALUES (?, ?)", (f, size))
+            changed.append((f, int(size), st.st_size, st.st_mtime_ns))
 
-        self.conn.commit()
+        metadata = [(None,) * 5] * len(changed)
+        if probing and changed:
+            with Pool() as pool:
+                metadata = pool.map(probe, [c[0] for c in changed])
+        rows = [c + m + (cost(m[0], m[2], m[3], m[4]), int(probing)) for (c, m) in zip(changed, metadata)]
 
+        # files left in known are gone
+        with self.conn:
+            self.conn.executemany("DELETE FROM videos WHERE fname = ?", ((f,) for f in known))
+            self.conn.executemany("INSERT OR REPLACE INTO videos(fname, size, bytes, mtime, duration, bitrate, width, height, codec, cost, probed) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(changed), len(known)
 
-    def get_fname(self, size):
+
+    def get_fname(self, size, by="size"):
         """
         Find a file with size nearest to X.
 
         :param size: size to look for
         :type size: int
-        :returns: tuple of filename and real size
+        :param by: 'size' or 'cost' to look for predicted transcoding cost in megapixel seconds instead
+        :type by: str
+        :returns: tuple of filename and real size (or cost)
         :rtype: tuple(str, int)
         """
 
+        if by not in ("size", "cost"):
+            raise Exception("Unknown column '{}'".format(by))
+        # nearest above and below on the index instead of sorting the whole table
         c = self.conn.cursor()
-        c.execute("SELECT fname, size FROM videos ORDER BY ABS(size - ?) LIMIT 1", (size,))
-        return c.fetchone()
+        c.execute("SELECT fname, {0} FROM videos WHERE {0} >= ? ORDER BY {0} LIMIT 1".format(by), (size,))
+        above = c.fetchone()
+        c.execute("SELECT fname, {0} FROM videos WHERE {0} < ? ORDER BY {0} DESC LIMIT 1".format(by), (size,))
+        below = c.fetchone()
+        if above is None and below is None:
+            self.check(by)
+        if above is None or below is None:
+            return above or below
+        return above if above[1] - size <= size - below[1] else below
+
+
+    def check(self, by="size"):
+        """
+        Raise an exception if no video has a value in column by.
+
+        :param by: 'size' or 'cost'
+        :type by: str
+        """
+        if self.statistics(by)[0] == 0:
+            raise Exception("There is no video with a {} in catalogue '{}'{}.".format(by, self.dbfile,
+                            " (is ffprobe installed?)" if by == "cost" else ""))
+
+
+    def statistics(self, by="size"):
+        """
+        :param by: 'size' or 'cost'
+        :type by: str
+        :returns: number of videos with a value in column by, its minimum, mean and maximum
+        :rtype: tuple(int, float, float, float)
+        """
+        if by not in ("size", "cost"):
+            raise Exception("Unknown column '{}'".format(by))
+        return self.conn.execute("SELECT COUNT({0}), MIN({0}), AVG({0}), MAX({0}) FROM videos".format(by)).fetchone()
+
+
+def benchmark(n=100000, queries=1000):
+    """
+    Compare the nearest size lookup of get_fname() with a full scan
+    on a catalogue of n random videos.
+
+    :returns: mean seconds per query of each variant
+    :rtype: dict
+    """
+    db = videos(path="")
+    db.conn.executemany("INSERT INTO videos(fname, size) VALUES (?, ?)",
+                        (("{}.mp4".format(i), random.randint(1, int(1e9))) for i in range(n)))
+    sizes = [random.randint(1, int(1e9)) for i in range(queries)]
+    result = dict()
+    t = time.monotonic()
+    for s in sizes:
+        db.conn.execute("SELECT fname, size FROM videos ORDER BY ABS(size - ?) LIMIT 1", (s,)).fetchone()
+    result["scan"] = (time.monotonic() - t) / queries
+    t = time.monotonic()
+    for s in sizes:
+        db.get_fname(s)
+    result["index"] = (time.monotonic() - t) / queries
+    return result
 
 
 class database(videos):
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2016 Markus Haehnel
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+"""
+Fake procfs and sysfs root to try sysmon.py without the vidserver, including CPU hotplug.
+"""
+
+
+import argparse
+import os, sys, time, threading, tempfile, subprocess, shutil, random
+import sysmon
+
+
+
+class FakeSys(threading.Thread):
+    """
+    Files read by sysmon below a root directory, whose counters advance while running.
+
+    Files are rewritten in place, as sysmon keeps them open.
+
+    :param root: directory of the tree, a new temporary one if None
+    :type root: str
+    :param cpus: number of CPUs
+    :type cpus: int
+    :param rate: updates of the counters per second
+    :type rate: float
+    :param hotplug: seconds between taking the last CPU offline and online again, never if None
+    :type hotplug: float
+    """
+    def __init__(self, root=None, cpus=2, rate=100, hotplug=None):
+        super().__init__(daemon=True)
+        self.root = tempfile.mkdtemp(prefix="fakesys-") if root is None else root
+        self.rate = rate
+        self.hotplug = hotplug
+        self.jiffies = [[0] * len(sysmon.CpuStat.fields) for c in range(cpus)]
+        self.online = [True] * cpus
+        self.net, self.disk = [0, 0], [0, 0]
+        self._stopped = threading.Event()
+        self._write("sys/devices/system/cpu/possible", "0-{}\n".format(cpus - 1))
+        for c in range(cpus):
+            self._write("sys/devices/system/cpu/cpu{}/cpufreq/scaling_cur_freq".format(c), "1200000\n")
+        self.update()
+
+    def _write(self, path, text):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+        try:
+            # pad a shorter text with blanks after its last line instead of truncating during a read
+            data = text.encode("ascii")
+            os.pwrite(fd, data + b" " * (os.fstat(fd).st_size - len(data)), 0)
+        finally:
+            os.close(fd)
+
+    def set_online(self, cpu, online):
+        self.online[cpu] = online
+        self._write("sys/devices/system/cpu/cpu{}/online".format(cpu), "1\n" if online else "0\n")
+
+    def update(self):
+        for (c, jiffies) in enumerate(self.jiffies):
+            if self.online[c]:
+                for i in (0, 2, 3):         # user, system, idle
+                    jiffies[i] += random.randint(0, 10)
+        total = [sum(v) for v in zip(*self.jiffies)]
+        self._write("proc/stat", "".join("{} {}\n".format(c, " ".join(str(v) for v in j)) for (c, j) in
+                    [("cpu ", total)] + [("cpu{}".format(c), j) for (c, j) in enumerate(self.jiffies) if self.online[c]])
+                    + "intr 0\n")
+        self._write("proc/meminfo", "MemTotal: {:12d} kB\nMemFree:  {:12d} kB\nBuffers:  {:12d} kB\nCached:   {:12d} kB\n".format(
+                    2000000, random.randint(900000, 1000000), 1000, 50000))
+        self.net = [v + random.randint(0, 1500) for v in self.net]
+        self._write("proc/net/dev", "Inter-|   Receive\n face |bytes\n"
+                    "    lo: {0:12d} 0 0 0 0 0 0 0 {0:12d} 0 0 0 0 0 0 0\n"
+                    "  eth0: {1:12d} 0 0 0 0 0 0 0 {2:12d} 0 0 0 0 0 0 0\n".format(0, *self.net))
+        self.disk = [v + random.randint(0, 8) for v in self.disk]
+        self._write("proc/diskstats", "   8       0 sda 0 0 {:12d} 0 0 0 {:12d} 0 0 0 0\n".format(*self.disk))
+
+    def run(self):
+        toggled = time.monotonic()
+        while not self._stopped.wait(1.0 / self.rate):
+            if self.hotplug is not None and time.monotonic() - toggled >= self.hotplug:
+                self.set_online(len(self.online) - 1, not self.online[-1])
+                toggled = time.monotonic()
+            self.update()
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+
+def check(samples=100, rate=50, **kwargs):
+    """
+    Sample a running fake root with sysmon.py and load its trace.
+
+    :returns: number of samples and of samples with the last CPU offline
+    :rtype: tuple(int, int)
+    """
+    fake = FakeSys(**kwargs)
+    fake.start()
+    fname = os.path.join(fake.root, "trace.bin")
+    try:
+        subprocess.check_call([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "sysmon.py"),
+                               "--root", fake.root, "-f", fname, "-r", str(rate), "-n", str(samples)])
+        trace = sysmon.load(fname)
+        return len(trace), int((trace["cpu{}.user".format(len(fake.online) - 1)] == -1).sum())
+    finally:
+        fake.stop()
+        if kwargs.get("root") is None:
+            shutil.rmtree(fake.root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(), formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--root", help="directory of the fake tree (default: a new temporary one)")
+    parser.add_argument("-c", "--cpus", type=int, default=2, help="number of CPUs")
+    parser.add_argument("-r", "--rate", type=float, default=100, help="updates of the counters per second")
+    parser.add_argument("--hotplug", type=float, metavar="SECONDS", help="toggle the last CPU offline and online")
+    parser.add_argument("--check", type=int, metavar="SAMPLES",
+                        help="run sysmon.py on the fake tree and load its trace instead of serving")
+    args = parser.parse_args()
+
+    if args.check:
+        n, offline = check(args.check, root=args.root, cpus=args.cpus, rate=args.rate, hotplug=args.hotplug)
+        print("{} samples, {} with the last CPU offline".format(n, offline))
+        return 0 if n == args.check else 1
+
+    fake = FakeSys(args.root, args.cpus, args.rate, args.hotplug)
+    print(fake.root)
+    fake.run()
+
+
+if __name__ == "__main__":
+    main()
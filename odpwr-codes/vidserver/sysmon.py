@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2016 Markus Haehnel
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+"""
+Sample CPU, memory, network and disk counters and CPU frequencies from procfs and sysfs
+into a binary trace, with little overhead compared to dstat.
+"""
+
+
+import argparse
+import os, sys, time, signal, struct, glob, json, resource
+
+
+
+class Source(object):
+    """
+    Counters parsed from a file, which is opened once and reread with pread.
+
+    Subclasses set names and parse the text into one value per name with parse().
+
+    :param path: path of file
+    :type path: str
+    """
+    bufsize = 65536
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.names = []
+
+    def text(self):
+        return os.pread(self.fd, self.bufsize, 0).decode("ascii")
+
+    def read(self):
+        """:rtype: list(int)"""
+        return self.parse(self.text())
+
+
+
+class CpuStat(Source):
+    """
+    Jiffies of total and each CPU from /proc/stat.
+
+    Columns are recorded for all possible CPUs of sys, so CPUs may go offline and
+    come online during a run. A CPU missing in /proc/stat has -1 in all its columns.
+    """
+    fields = ("user", "nice", "system", "idle", "iowait", "irq", "softirq", "steal")
+
+    def __init__(self, root="/"):
+        super().__init__(os.path.join(root, "proc/stat"))
+        self.cpus = ["cpu"] + sorted((l.split()[0] for l in self.text().splitlines() if l.startswith("cpu") and l[3].isdigit()),
+                                     key=lambda c: int(c[3:]))
+        try:
+            with open(os.path.join(root, "sys/devices/system/cpu/possible")) as f:
+                self.cpus = ["cpu"] + ["cpu{}".format(c) for c in parse_cpulist(f.read())]
+        except FileNotFoundError:
+            pass
+        self.names = ["{}.{}".format(c, f) for c in self.cpus for f in self.fields]
+
+    def parse(self, text):
+        values = dict()
+        for l in text.splitlines():
+            if not l.startswith("cpu"):
+                break
+            cpu, *v = l.split()[:len(self.fields)+1]
+            values[cpu] = [int(x) for x in v] + [0] * (len(self.fields) - len(v))
+        absent = [-1] * len(self.fields)
+        return [v for c in self.cpus for v in values.get(c, absent)]
+
+
+
+class MemInfo(Source):
+    """Memory [kB] from /proc/meminfo."""
+    def __init__(self, root="/", keys=("MemTotal", "MemFree", "Buffers", "Cached")):
+        super().__init__(os.path.join(root, "proc/meminfo"))
+        self.keys = keys
+        self.names = ["mem.{}".format(k) for k in keys]
+
+    def parse(self, text):
+        values = dict()
+        for l in text.splitlines():
+            key, _, value = l.partition(":")
+            values[key] = value
+        return [int(values[k].split()[0]) if k in values else 0 for k in self.keys]
+
+
+
+class NetDev(Source):
+    """
+    Received and sent bytes of network interfaces from /proc/net/dev.
+
+    :param interfaces: interface names, all but loopback if None
+    :type interfaces: list(str)
+    """
+    def __init__(self, root="/", interfaces=None):
+        super().__init__(os.path.join(root, "proc/net/dev"))
+        self.interfaces = interfaces or [i for i in self._counters(self.text()) if i != "lo"]
+        self.names = ["net.{}.{}".format(i, d) for i in self.interfaces for d in ("recv", "send")]
+
+    def _counters(self, text):
+        counters = dict()
+        for l in text.splitlines()[2:]:
+            name, _, values = l.partition(":")
+            values = values.split()
+            counters[name.strip()] = (int(values[0]), int(values[8]))
+        return counters
+
+    def parse(self, text):
+        counters = self._counters(text)
+        return [v for i in self.interfaces for v in counters.get(i, (0, 0))]
+
+
+
+class DiskStats(Source):
+    """
+    Read and written bytes of block devices from /proc/diskstats.
+
+    :param disks: device names, all disks listed in /sys/block but loop and ram devices if None
+    :type disks: list(str)
+    """
+    def __init__(self, root="/", disks=None):
+        super().__init__(os.path.join(root, "proc/diskstats"))
+        if disks is None:
+            block = os.path.join(root, "sys/block")
+            disks = [d for d in self._counters(self.text()) if not d.startswith(("loop", "ram", "zram"))
+                     and (not os.path.isdir(block) or os.path.exists(os.path.join(block, d)))]
+        self.disks = disks
+        self.names = ["disk.{}.{}".format(d, o) for d in self.disks for o in ("read", "writ")]
+
+    def _counters(self, text):
+        counters = dict()
+        for l in text.splitlines():
+            values = l.split()
+            counters[values[2]] = (int(values[5]) * 512, int(values[9]) * 512)      # sectors
+        return counters
+
+    def parse(self, text):
+        counters = self._counters(text)
+        return [v for d in self.disks for v in counters.get(d, (0, 0))]
+
+
+
+class CpuFreq(object):
+    """Current frequency [kHz] of each CPU from cpufreq's scaling_cur_freq in sysfs, -1 while it is offline."""
+    def __init__(self, root="/"):
+        paths = glob.glob(os.path.join(root, "sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq"))
+        cpu = lambda p: int(os.path.basename(os.path.dirname(os.path.dirname(p)))[3:])
+        paths.sort(key=cpu)
+        self.fds = [os.open(p, os.O_RDONLY) for p in paths]
+        self.names = ["freq.cpu{}".format(cpu(p)) for p in paths]
+
+    def read(self):
+        values = []
+        for fd in self.fds:
+            try:
+                values.append(int(os.pread(fd, 32, 0)))
+            except (OSError, ValueError):
+                values.append(-1)
+        return values
+
+
+
+def parse_cpulist(cpulist):
+    """Convert a CPU list of sysfs, e.g. '0-3,8', to a list of CPUs."""
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if part:
+            first, _, last = part.partition("-")
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+
+class Trace(object):
+    """
+    Binary trace of fixed-width records: float64 UNIX timestamp and int64 counters.
+
+    The file starts with a line of the magic and a JSON line of the counters' names.
+
+    :param fname: path of trace file
+    :type fname: str
+    :param names: names of counters
+    :type names: list(str)
+    :param buffersize: number of records collected before writing
+    :type buffersize: int
+    """
+    magic = b"SYSMON"
+
+    def __init__(self, fname, names, buffersize=16):
+        self.record = struct.Struct("<d" + "q" * len(names))
+        self._file = open(fname, "wb")
+        self._file.write(self.magic + b"\n" + json.dumps(names).encode() + b"\n")
+        self._buffer = []
+        self.buffersize = buffersize
+
+    def write(self, timestamp, values):
+        self._buffer.append(self.record.pack(timestamp, *values))
+        if len(self._buffer) >= self.buffersize:
+            self.flush()
+
+    def flush(self):
+        self._file.write(b"".join(self._buffer))
+        self._file.flush()
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+
+def load(fname):
+    """
+    Memory-map a trace into a NumPy record array with fields timestamp and the counters' names.
+    """
+    import numpy
+
+    with open(fname, "rb") as f:
+        if f.readline() != Trace.magic + b"\n":
+            raise Exception("'{}' is no sysmon trace.".format(fname))
+        names = json.loads(f.readline().decode())
+        offset = f.tell()
+    dtype = numpy.dtype([("timestamp", "<f8")] + [(n, "<i8") for n in names])
+    n = (os.path.getsize(fname) - offset) // dtype.itemsize     # ignore a partly written last record
+    return numpy.memmap(fname, dtype=dtype, mode="r", offset=offset, shape=(n,))
+
+
+
+def overhead(start, samples):
+    """CPU time of this process since start (wall clock, CPU seconds) in percent of one CPU and per sample."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime - start[1]
+    wall = time.monotonic() - start[0]
+    return "overhead: {:.3f} % CPU, {:.0f} us per sample ({} samples in {:.1f} s)".format(
+            100 * cpu / wall if wall else 0, 1e6 * cpu / samples if samples else 0, samples, wall)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(), formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-f", "--file", required=True, help="binary trace file, see load()")
+    parser.add_argument("-r", "--rate", type=float, default=1, help="samples per second")
+    parser.add_argument("-n", "--count", type=int, help="stop after number of samples")
+    parser.add_argument("-N", "--net", type=lambda s: s.split(","), help="network interfaces (default: all but lo)")
+    parser.add_argument("-D", "--disk", type=lambda s: s.split(","), help="block devices (default: all disks)")
+    parser.add_argument("--root", default="/", help="root of proc and sys, e.g. a fake one of fakesys.py for testing")
+    args = parser.parse_args()
+
+    sources = [CpuStat(args.root), MemInfo(args.root), NetDev(args.root, args.net),
+               DiskStats(args.root, args.disk), CpuFreq(args.root)]
+    trace = Trace(args.file, [n for s in sources for n in s.names])
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = (time.monotonic(), usage.ru_utime + usage.ru_stime)
+    samples = 0
+
+    # flush buffered records when stopped with kill
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit())
+    signal.signal(signal.SIGUSR1, lambda *args: print(overhead(start, samples), file=sys.stderr))
+
+    interval = 1.0 / args.rate
+    deadline = time.monotonic()
+    try:
+        while args.count is None or samples < args.count:
+            values = []
+            for s in sources:
+                values.extend(s.read())
+            trace.write(time.time(), values)
+            samples += 1
+            deadline += interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                deadline = time.monotonic()     # too slow: do not catch up in bursts
+    finally:
+        trace.close()
+        print(overhead(start, samples), file=sys.stderr)
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    main()
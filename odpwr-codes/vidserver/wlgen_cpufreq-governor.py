@@ -27,56 +27,355 @@ Generate workload with stochastic rate and video size with FFmpeg.
 
 import argparse
 import database
-import os, sys, time, signal, shutil
-from multiprocessing import cpu_count
-import random, subprocess
+import os, sys, time, signal, shutil, select
+import random, subprocess, collections, itertools, math, csv, json
 
 
 
 # Globals
-processes = {}      # { fname : subprocess.Popen }
+scheduler = None
 dstdir = None
+wakeup = None       # read end of pipe written on signals, e.g. SIGCHLD
 
 
 
 def quit_properly(*args, **kwargs):
-    for p in processes.values():
-        p.terminate()
+    if scheduler is not None:
+        scheduler.terminate()
     shutil.rmtree(dstdir)
     sys.exit()
 
 
 
-def remove_finished_files():
-    finished = []
-    for (key, val) in processes.items():
-        if val.poll() is not None:
-            print("Delete '{}'.".format(key))
-            finished.append(key)
-            os.remove(key)
-    for key in finished:
-        del processes[key]
+def watch_children():
+    """Let wait_for_children() return as soon as a child process terminates."""
+    global wakeup
+    wakeup, w = os.pipe()
+    os.set_blocking(wakeup, False)
+    os.set_blocking(w, False)
+    signal.set_wakeup_fd(w)
+    signal.signal(signal.SIGCHLD, lambda *args: None)
 
 
 
-def workload(wait, size, args):
+def wait_for_children(timeout):
+    """Sleep until timeout or until a child process has terminated."""
+    if select.select([wakeup], [], [], timeout)[0]:
+        os.read(wakeup, 4096)
+
+
+
+# Arrival processes: generators of (seconds since start, video size or None to draw one)
+
+def constant(wait):
+    t = 0.0
+    while True:
+        yield t, None
+        t += wait()
+
+
+
+def poisson(rate):
+    t = 0.0
+    while True:
+        t += random.expovariate(rate)
+        yield t, None
+
+
+
+def mmpp(rate, burst, dwell):
+    """Markov-modulated Poisson process alternating between a bursty and a quiet state with mean rate."""
+    high = 2 * rate * burst / (burst + 1)
+    rates = (high, high / burst)
+    t, state = 0.0, 0
+    switch = random.expovariate(1.0 / dwell)
+    while True:
+        t += random.expovariate(rates[state])
+        while t >= switch:
+            # memoryless: restart at the switch with the rate of the new state
+            t, state = switch, 1 - state
+            switch += random.expovariate(1.0 / dwell)
+            t += random.expovariate(rates[state])
+        yield t, None
+
+
+
+def diurnal(rate, amplitude, period):
+    """Poisson process with sinusoidal rate, generated by thinning."""
+    peak = rate * (1 + amplitude)
+    t = 0.0
+    while True:
+        t += random.expovariate(peak)
+        if random.random() * peak <= rate * (1 + amplitude * math.sin(2 * math.pi * t / period)):
+            yield t, None
+
+
+
+def replay(fname):
+    """Arrivals of a recorded trace, CSV lines of 'seconds[,size]'."""
+    with open(fname) as f:
+        for row in csv.reader(f):
+            try:
+                t = float(row[0])
+            except (ValueError, IndexError):     # header or empty line
+                continue
+            yield t, float(row[1]) if len(row) > 1 and row[1] else None
+
+
+
+class Rapl(object):
+    """
+    Energy counter of a RAPL domain, e.g. the package.
+
+    :param path: powercap directory of the domain
+    :type path: str
+    """
+    def __init__(self, path="/sys/class/powercap/intel-rapl:0"):
+        fname = os.path.join(path, "energy_uj")
+        try:
+            self.fd = os.open(fname, os.O_RDONLY)
+        except PermissionError:
+            raise Exception("Reading '{0}' requires root or a relaxed file mode, e.g. 'sudo chmod o+r {0}'.".format(fname))
+        with open(os.path.join(path, "max_energy_range_uj")) as f:
+            self.range = int(f.read()) + 1
+
+    def read(self):
+        """Counter in microjoules."""
+        return int(os.pread(self.fd, 32, 0))
+
+    def joules(self, begin, end):
+        return (end - begin) % self.range / 1e6      # the counter wraps around
+
+
+
+class Job(object):
+    """
+    Transcoding of a video on a CPU.
+
+    :param cpu: CPU the transcoding is bound to
+    :type cpu: int
+    :param src: path of video
+    :type src: str
+    :param dst: path of transcoded video, deleted when finished, None to discard it in FFmpeg's null muxer
+    :type dst: str
+    :param rapl: energy counter read at start and end of the transcoding
+    :type rapl: Rapl
+    """
+    def __init__(self, cpu, src, dst, rapl=None):
+        self.cpu, self.src, self.dst = cpu, src, dst
+        self.bytes = os.path.getsize(src)
+        self.submitted = time.time()
+        self.started, self.finished = None, None
+        self.process = None
+        self.rusage = None
+        self.rapl, self.energy = rapl, None
+
+    def start(self):
+        self.started = time.time()
+        if self.rapl is not None:
+            self.energy = self.rapl.read()
+        output = ["-f", "null", "-"] if self.dst is None else ["-y", self.dst]
+        # no shell and no taskset: bind the forked child before exec of FFmpeg
+        self.process = subprocess.Popen(["ffmpeg", "-nostdin", "-loglevel", "0", "-i", self.src,
+                                         "-vcodec", "flv", "-acodec", "adpcm_swf", "-ar", "44100", "-ac", "2"] + output,
+                                        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                        preexec_fn=lambda: os.sched_setaffinity(0, {self.cpu}))
+
+    def poll(self):
+        """Return True and clean up if the transcoding has finished."""
+        # reap the child ourselves to get its resource usage
+        pid, status, self.rusage = os.wait4(self.process.pid, os.WNOHANG)
+        if pid == 0:
+            return False
+        self.finished = time.time()
+        self.process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        if self.rapl is not None:
+            self.energy = self.rapl.joules(self.energy, self.rapl.read())
+        if self.dst is None:
+            print("Finished '{}' (CPU {}, started {:.3f}, finished {:.3f}).".format(self.src, self.cpu, self.started, self.finished))
+            return True
+        print("Delete '{}' (CPU {}, started {:.3f}, finished {:.3f}).".format(self.dst, self.cpu, self.started, self.finished))
+        if os.path.exists(self.dst):
+            os.remove(self.dst)
+        return True
+
+
+
+class Scheduler(object):
+    """
+    Per-CPU job queues with a bounded number of running transcodings per CPU.
+
+    :param cpus: CPUs jobs are started on
+    :type cpus: list(int)
+    :param inflight: maximal running jobs per CPU, None for unbounded
+    :type inflight: int
+    :param queue: maximal waiting jobs per CPU, None for unbounded
+    :type queue: int
+    :param joblog: file to write one CSV line per finished or dropped job to
+    :type joblog: file
+    :param statefile: path of JSON file of running and waiting jobs per CPU, rewritten on every change (see wlgov.py)
+    :type statefile: str
+    """
+    def __init__(self, cpus, inflight=None, queue=None, joblog=None, statefile=None):
+        self.inflight = inflight
+        self.queue = queue
+        self.queues = {c: collections.deque() for c in cpus}
+        self.running = {c: [] for c in cpus}
+        self.dropped = 0
+        self.joblog = joblog
+        self.statefile = statefile
+        self._published = None
+        if joblog is not None:
+            joblog.write("cpu,src,bytes,submitted,started,finished,queueing,service,status,"
+                         "utime,stime,maxrss,nvcsw,nivcsw,energy\n")
+
+    def full(self, cpu):
+        """Check whether a new job for CPU would have to wait but the queue is at its limit."""
+        return self.queue is not None and not self.idle(cpu) and len(self.queues[cpu]) >= self.queue
+
+    def least_loaded(self):
+        """CPU with fewest waiting and running jobs."""
+        return min(self.queues, key=lambda c: len(self.queues[c]) + len(self.running[c]))
+
+    def busy(self):
+        return any(self.queues.values()) or any(self.running.values())
+
+    def idle(self, cpu):
+        """Check whether CPU has neither waiting jobs nor all job slots in use."""
+        return not self.queues[cpu] and self._free(cpu)
+
+    def submit(self, job):
+        """Start job on a free slot or queue it, drop it if it would have to wait in a full queue."""
+        if self.full(job.cpu):
+            self.dropped += 1
+            self._log(job, "dropped")
+            return False
+        self.queues[job.cpu].append(job)
+        self._dispatch(job.cpu)
+        self._publish()
+        return True
+
+    def poll(self):
+        """Clean up finished jobs and start waiting ones on free slots."""
+        for (cpu, running) in self.running.items():
+            for job in [j for j in running if j.poll()]:
+                running.remove(job)
+                self._log(job, job.process.returncode)
+            self._dispatch(cpu)
+        self._publish()
+
+    def _free(self, cpu):
+        return self.inflight is None or len(self.running[cpu]) < self.inflight
+
+    def _dispatch(self, cpu):
+        while self.queues[cpu] and self._free(cpu):
+            job = self.queues[cpu].popleft()
+            job.start()
+            self.running[cpu].append(job)
+
+    def _log(self, job, status):
+        if self.joblog is None:
+            return
+        queueing = "" if job.started is None else job.started - job.submitted
+        service = "" if job.finished is None else job.finished - job.started
+        r = job.rusage
+        usage = ",,,," if r is None else "{:.3f},{:.3f},{},{},{}".format(r.ru_utime, r.ru_stime, r.ru_maxrss, r.ru_nvcsw, r.ru_nivcsw)
+        self.joblog.write("{},{},{},{},{},{},{},{},{},{},{}\n".format(job.cpu, job.src, job.bytes, job.submitted,
+                          "" if job.started is None else job.started,
+                          "" if job.finished is None else job.finished,
+                          queueing, service, status, usage,
+                          "" if job.finished is None or job.energy is None else "{:.6f}".format(job.energy)))
+        self.joblog.flush()
+
+    def _publish(self):
+        """Write running jobs, waiting jobs and submission time of the oldest waiting one per CPU to the state file if changed."""
+        if self.statefile is None:
+            return
+        cpus = {str(c): dict(running=len(self.running[c]), queued=len(q), since=q[0].submitted if q else None)
+                for (c, q) in self.queues.items()}
+        if cpus == self._published:
+            return
+        self._published = cpus
+        state = dict(time=time.time(), inflight=self.inflight, cpus=cpus)
+        with open(self.statefile + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.statefile + ".tmp", self.statefile)
+
+    def terminate(self):
+        for running in self.running.values():
+            for job in running:
+                job.process.terminate()
+        if self.statefile is not None and os.path.exists(self.statefile):
+            os.remove(self.statefile)
+
+
+
+def workload(arrivals, size, args):
     if not os.path.isdir(args.dstdir):
         os.mkdir(args.dstdir)
-    db = database.database()
+    db = database.database(dbfile=args.dbfile)
+    db.check(args.by)
+    n, lowest, mean, highest = db.statistics(args.by)
+    # parameters of the size distribution not given are in bytes for size and scaled to the catalogued costs for cost
+    defaults = dict(vmax=50e6, csize=40e6, mu=15e6, gmu=15e6, gsigma=7.5e6, uvmin=1) if args.by == "size" else \
+               dict(vmax=highest, csize=mean, mu=mean, gmu=mean, gsigma=mean/2, uvmin=lowest)
+    for (name, value) in defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+    rapl = None if args.rapl is None else Rapl(args.rapl)
+    global scheduler
+    scheduler = Scheduler(args.cpus, inflight=args.inflight, queue=args.queue,
+                          joblog=None if args.joblog is None else open(args.joblog, "a"), statefile=args.state)
+
+    numbers = itertools.count()
+    def new_job(cpu, s=None):
+        s = size() if s is None else s
+        s = int(s) if args.by == "size" else s
+        src = db.get_fname(s, by=args.by)
+        print("{}\t{:+1.3f} %\t on CPU {:2}".format("Size: {:5.1f} MiB".format(s/1024**2) if args.by == "size" else
+                "Cost: {:5.1f} MPs".format(s), (src[1]-s)/s*100, cpu))
+        return Job(cpu, src[0], None if args.output == "null" else os.path.join(args.dstdir, "{}_{}.flv".format(next(numbers), s)), rapl)
+
+    watch_children()
+    # arrivals are scheduled on the monotonic clock relative to start,
+    # so time spent on starting jobs does not shift the following ones
+    start = time.monotonic()
+    arrival = next(arrivals, None)
+    blocked = None
     while True:
 
-        remove_finished_files()
+        scheduler.poll()
+        now = time.monotonic()
+
+        if args.loop == "closed":
+            # keep every CPU busy: a new job as soon as one has finished
+            for cpu in args.cpus:
+                while scheduler.idle(cpu):
+                    if not scheduler.submit(new_job(cpu)):
+                        break
+        elif arrival is None:
+            # end of trace
+            if not scheduler.busy():
+                return
+        elif now >= start + arrival[0]:
+            # backpressure: hold arrivals back while a queue is full
+            if args.policy == "block" and any(scheduler.full(cpu) for cpu in args.cpus):
+                blocked = now if blocked is None else blocked
+                wait_for_children(args.poll)
+                continue
+            if blocked is not None:
+                start += now - blocked
+                blocked = None
+            # constant: one transcoding on each CPU, else on the least loaded
+            for cpu in (args.cpus if args.arrival == "const" else [scheduler.least_loaded()]):
+                scheduler.submit(new_job(cpu, arrival[1]))
+            arrival = next(arrivals, None)
+            if arrival is not None:
+                print("Wait: {:2.2f} s".format(start + arrival[0] - time.monotonic()))
+            continue
 
-        for cpu in args.cpus:
-            s = int(size())
-            src = db.get_fname(s)
-            dst = os.path.join(args.dstdir, str(s)+".flv")
-            processes[dst] = subprocess.Popen(
-                                "taskset -c {} ffmpeg -loglevel 0 -i {} -vcodec flv -acodec adpcm_swf -ar 44100 -ac 2 -y {} > /dev/null 2>&1".format(cpu, src[0], dst), shell=True)
-            print("Size: {:5.1f} MiB\t{:+1.3f} %\t on CPU {:2}".format(s/1024**2, (src[1]-s)/s*100, cpu))
-        w = wait()
-        print("Wait: {:2.2f} s".format(w))
-        time.sleep(w)
+        wait_for_children(args.poll if args.loop == "closed" or arrival is None else
+                          min(args.poll, max(0, start + arrival[0] - time.monotonic())))
 
 
 
@@ -85,30 +384,80 @@ def main():
     parser = argparse.ArgumentParser(description="Video transcoding workload generator.",
                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("-d", "--dstdir", default="/home/odroid/Documents/cpufreq/", help="temporary destination directory of transcoded videos")
-    parser.add_argument("--vmax", type=int, default=int(50e6), help="maximum video size")
-    parser.add_argument("-c", "--cpus", type=lambda s: [int(i) for i in s.split(",")], default=list(range(cpu_count())), help="list of CPUs a transcoding is started on after every wait")
+    parser.add_argument("-o", "--output", choices=["disk", "tmpfs", "null"], default="disk",
+                        help="write transcoded videos to --dstdir, to a directory in /dev/shm or discard them in FFmpeg's null muxer")
+    parser.add_argument("--dbfile", default="/home/odroid/Documents/videos.sqlite", help="video catalogue, updated on start")
+    parser.add_argument("--by", choices=["size", "cost"], default="size", help="match drawn values against video size or predicted transcoding cost (megapixel seconds)")
+    parser.add_argument("--vmax", type=float, help="maximum video size (bytes: 50e6, cost: highest catalogued)")
+    parser.add_argument("-c", "--cpus", type=lambda s: [int(i) for i in s.split(",")], default=sorted(os.sched_getaffinity(0)), help="list of CPUs a transcoding is started on after every wait")
 
-    parser.add_argument("-w", "--wait", type=int, default=30, help="time between transcodings")
+    parser.add_argument("-w", "--wait", type=int, default=30, help="time between transcodings, mean time per CPU for other arrivals than 'const'")
+
+    parser.add_argument("-a", "--arrival", choices=["const", "poisson", "mmpp", "diurnal", "trace"], default="const",
+                        help="arrival process, every arrival but 'const' starts one transcoding on the least loaded CPU")
+    group = parser.add_argument_group("Arrival: bursty ('mmpp')")
+    group.add_argument("--burst", type=float, default=5, help="ratio of rates of bursty and quiet state")
+    group.add_argument("--dwell", type=float, default=60, help="mean time in each state")
+    group = parser.add_argument_group("Arrival: daily pattern ('diurnal')")
+    group.add_argument("--amplitude", type=float, default=0.5, help="relative amplitude of rate")
+    group.add_argument("--period", type=float, default=86400, help="period of rate")
+    group = parser.add_argument_group("Arrival: replay of recorded requests ('trace')")
+    group.add_argument("--trace", help="CSV file of lines 'seconds since start[,size]'")
+
+    group = parser.add_argument_group("Scheduling")
+    group.add_argument("--loop", choices=["open", "closed"], default="open", help="start transcodings after every wait ('open') or whenever one has finished ('closed')")
+    group.add_argument("--inflight", type=int, help="maximal running transcodings per CPU, unbounded if not given (1 for 'closed')")
+    group.add_argument("--queue", type=int, help="maximal waiting transcodings per CPU, unbounded if not given")
+    group.add_argument("--policy", choices=["drop", "block"], default="drop", help="on a full queue drop new transcodings or hold the arrivals back")
+    group.add_argument("--poll", type=float, default=5, help="maximal interval of checking for finished transcodings, which are noticed on SIGCHLD anyway")
+    group.add_argument("--joblog", help="CSV file of size, queueing delay, service time and resource usage of each transcoding")
+    group.add_argument("--state", help="JSON file of running and waiting transcodings per CPU for wlgov.py, e.g. in /dev/shm")
+    group.add_argument("--rapl", nargs="?", const="/sys/class/powercap/intel-rapl:0",
+                       help="log the energy of a RAPL domain during each transcoding (shared by concurrent ones), "
+                            "its energy_uj is readable by root only unless its file mode is relaxed")
 
     parser.add_argument("-s", "--size", choices=["const", "exp", "gauss", "uni"], default="exp", help="distribution of video size")
     group = parser.add_argument_group("Size: constant ('const')")
-    group.add_argument("--csize", type=int, default=int(40e6), help="video size")
+    group.add_argument("--csize", type=float, help="video size (bytes: 40e6, cost: mean catalogued)")
     group = parser.add_argument_group("Size: exponential distributed ('exp')")
-    group.add_argument("-m", "--mu", type=float, default=int(15e6), help="expectation value")     # mu_db = 93770466
+    group.add_argument("-m", "--mu", type=float, help="expectation value (bytes: 15e6, cost: mean catalogued)")     # mu_db = 93770466
     group = parser.add_argument_group("Size: normal distributed ('gauss')")
-    group.add_argument("--gmu", type=float, default=int(15e6), help="expectation value")
-    group.add_argument("--gsigma", type=float, default=int(7.5e6), help="standard deviation")
+    group.add_argument("--gmu", type=float, help="expectation value (bytes: 15e6, cost: mean catalogued)")
+    group.add_argument("--gsigma", type=float, help="standard deviation (bytes: 7.5e6, cost: half the mean catalogued)")
     group = parser.add_argument_group("Size: uniform distributed ('uni')")
-    group.add_argument("--uvmin", type=int, default=1, help="minimal video size")
+    group.add_argument("--uvmin", type=float, help="minimal video size, also of 'gauss' (bytes: 1, cost: lowest catalogued)")
 
     args = parser.parse_args()
+    unavailable = sorted(set(args.cpus) - os.sched_getaffinity(0))
+    if unavailable:
+        parser.error("CPU(s) {} not available, available are {}".format(",".join(str(c) for c in unavailable),
+                     ",".join(str(c) for c in sorted(os.sched_getaffinity(0)))))
+    if args.output == "tmpfs":
+        args.dstdir = os.path.join("/dev/shm", os.path.basename(os.path.normpath(args.dstdir)))
+    if args.loop == "closed" and args.inflight is None:
+        args.inflight = 1
+    if args.arrival in ("poisson", "mmpp", "diurnal") and args.wait <= 0:
+        parser.error("arrival '{}' needs a positive --wait".format(args.arrival))
     wait = lambda: args.wait
+    rate = len(args.cpus) / args.wait if args.wait else None
+    if args.arrival == "const":
+        arrivals = constant(wait)
+    elif args.arrival == "poisson":
+        arrivals = poisson(rate)
+    elif args.arrival == "mmpp":
+        arrivals = mmpp(rate, args.burst, args.dwell)
+    elif args.arrival == "diurnal":
+        arrivals = diurnal(rate, args.amplitude, args.period)
+    elif args.arrival == "trace":
+        if args.trace is None:
+            parser.error("--trace is required for arrival 'trace'")
+        arrivals = replay(args.trace)
     if args.size == "const":
         size = lambda: min(args.csize, args.vmax)
     elif args.size == "exp":
         size = lambda: min(random.expovariate(1.0/args.mu), args.vmax)
     elif args.size == "gauss":
-        size = lambda: max(1, min(random.normalvariate(args.gmu, args.gsigma), args.vmax))
+        size = lambda: max(args.uvmin, min(random.normalvariate(args.gmu, args.gsigma), args.vmax))
     elif args.size == "uni":
         size = lambda: random.uniform(args.uvmin, args.vmax)
 
@@ -116,7 +465,8 @@ def main():
     dstdir = args.dstdir
     for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
         signal.signal(sig, quit_properly)
-    workload(wait, size, args)
+    workload(arrivals, size, args)
+    shutil.rmtree(dstdir)
 
     return 0
 
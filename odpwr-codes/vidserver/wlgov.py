@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  Copyright 2016 Markus Haehnel
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+"""
+Userspace cpufreq governor driven by the running and waiting transcodings of wlgen.
+
+Idle CPUs run at the lowest frequency, busy ones at a base frequency that rises
+with the waiting time of the oldest queued transcoding up to the highest one.
+"""
+
+
+import argparse
+import os, sys, time, signal, glob, json, bisect, collections
+
+
+
+class Cpu(object):
+    """
+    cpufreq of a logical CPU, set with pwrite on descriptors opened once.
+
+    :param cpu: number of logical CPU
+    :type cpu: int
+    :param root: root of sys, e.g. a fake one for testing
+    :type root: str
+    :param mode: write scaling_setspeed ('setspeed', needs governor userspace) or scaling_min_freq and scaling_max_freq ('minmax')
+    :type mode: str
+    """
+    def __init__(self, cpu, root="/", mode="setspeed"):
+        path = os.path.join(root, "sys/devices/system/cpu/cpu{}/cpufreq".format(cpu))
+        read = lambda name: open(os.path.join(path, name)).read().split()
+        self.cpu = cpu
+        self.min, self.max = int(read("cpuinfo_min_freq")[0]), int(read("cpuinfo_max_freq")[0])
+        try:
+            self.frequencies = sorted(int(f) for f in read("scaling_available_frequencies"))
+        except FileNotFoundError:
+            self.frequencies = [self.min, self.max]
+        self.mode = mode
+        names = ("scaling_setspeed",) if mode == "setspeed" else ("scaling_min_freq", "scaling_max_freq")
+        self.fds = [os.open(os.path.join(path, n), os.O_WRONLY) for n in names]
+        self.truncate = os.path.abspath(root) != "/"        # regular files of a fake sys keep longer old values
+        self.current, self._since = None, None
+        self.changes = 0
+        self.residency = collections.Counter()      # seconds per frequency
+
+    def quantize(self, frequency):
+        """Lowest available frequency not below frequency."""
+        i = bisect.bisect_left(self.frequencies, frequency)
+        return self.frequencies[min(i, len(self.frequencies) - 1)]
+
+    def _write(self, fd, frequency):
+        value = "{}\n".format(frequency).encode()
+        os.pwrite(fd, value, 0)
+        if self.truncate:
+            os.ftruncate(fd, len(value))
+
+    def set(self, frequency):
+        frequency = self.quantize(frequency)
+        if frequency == self.current:
+            return
+        if self.mode == "setspeed":
+            self._write(self.fds[0], frequency)
+        else:
+            if self.current is None:
+                self._write(self.fds[0], self.min)
+            # keep minimum below maximum during the change
+            for fd in (self.fds[::-1] if self.current is None or frequency > self.current else self.fds):
+                self._write(fd, frequency)
+        now = time.monotonic()
+        if self.current is not None:
+            self.residency[self.current] += now - self._since
+        self.current, self._since = frequency, now
+        self.changes += 1
+
+    def stats(self):
+        residency = self.residency.copy()
+        if self.current is not None:
+            residency[self.current] += time.monotonic() - self._since
+        return "CPU {}: {} changes, {}".format(self.cpu, self.changes,
+                ", ".join("{} MHz {:.1f} s".format(f // 1000, t) for (f, t) in sorted(residency.items())))
+
+
+
+def target(cpu, state, now, delay, base):
+    """
+    Frequency of CPU for the state of wlgen.
+
+    :param state: state of wlgen (see Scheduler._publish()), None if wlgen is not running
+    :type state: dict
+    :param delay: waiting time of the oldest transcoding at which the highest frequency is reached
+    :type delay: float
+    :param base: frequency of a busy CPU without waiting transcodings as fraction between lowest and highest one
+    :type base: float
+    """
+    jobs = None if state is None else state["cpus"].get(str(cpu.cpu))
+    if jobs is None or jobs["running"] + jobs["queued"] == 0:
+        return cpu.min
+    if jobs["running"] > 1:         # transcodings share the CPU
+        return cpu.max
+    busy = cpu.min + base * (cpu.max - cpu.min)
+    waited = 0.0 if jobs["since"] is None else now - jobs["since"]
+    return busy + (cpu.max - busy) * (min(1.0, waited / delay) if delay > 0 else 1.0 if jobs["queued"] else 0.0)
+
+
+
+def read_state(fname):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(), formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-s", "--state", default="/dev/shm/wlgen.state", help="state file written by wlgen --state")
+    parser.add_argument("-c", "--cpus", type=lambda s: [int(i) for i in s.split(",")], help="controlled CPUs (default: all with cpufreq)")
+    parser.add_argument("-m", "--mode", choices=["setspeed", "minmax"], default="setspeed",
+                        help="write scaling_setspeed of governor userspace or scaling_min/max_freq of any governor")
+    parser.add_argument("-i", "--interval", type=float, default=0.05, help="seconds between control steps")
+    parser.add_argument("-d", "--delay", type=float, default=5, help="waiting time of the oldest queued transcoding at which the highest frequency is set")
+    parser.add_argument("-b", "--base", type=float, default=0.5, help="frequency of busy CPUs without waiting transcodings between lowest (0) and highest (1) one")
+    parser.add_argument("--root", default="/", help="root of sys, e.g. a fake one for testing")
+    args = parser.parse_args()
+
+    if args.cpus is None:
+        args.cpus = sorted(int(os.path.basename(os.path.dirname(p))[3:]) for p in
+                           glob.glob(os.path.join(args.root, "sys/devices/system/cpu/cpu[0-9]*/cpufreq")))
+    cpus = [Cpu(c, args.root, args.mode) for c in args.cpus]
+
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit())
+
+    mtime, state = None, None
+    try:
+        while True:
+            # reread the state only if wlgen has changed it
+            try:
+                m = os.stat(args.state).st_mtime_ns
+            except FileNotFoundError:
+                m = None
+            if m != mtime:
+                state = None if m is None else read_state(args.state)
+                mtime = m if state is not None else None
+            now = time.time()
+            for cpu in cpus:
+                cpu.set(target(cpu, state, now, args.delay, args.base))
+            time.sleep(args.interval)
+    finally:
+        for cpu in cpus:
+            print(cpu.stats(), file=sys.stderr)
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    main()